@@ -1,159 +1,2621 @@
+import argparse
+import asyncio
+import csv
+import mmap
+import multiprocessing
+import os
+import random
+import signal
 import socket
+import ssl
 import struct
+import sys
 import time
-import selectors
+import zlib
+from bisect import bisect_left
+from ipaddress import ip_network
+from itertools import islice
+from collections import OrderedDict, deque
 from concurrent.futures import ThreadPoolExecutor
-from threading import Thread
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Lock, Thread, local
 
-# DNS серверы для использования
+# DNS серверы для использования: '1.1.1.1' (UDP), 'tls://1.1.1.1#cloudflare-dns.com' (DNS-over-TLS)
+# или 'https://cloudflare-dns.com/dns-query' (DNS-over-HTTPS); после '#' - имя в сертификате сервера
 DNS_SERVERS = ['1.1.1.1', '8.8.8.8', '8.8.4.4', '208.67.222.222', '77.88.8.8']
 DNS_TIMEOUT = 1.0  # Тайм-аут для запроса к серверу
-CACHE_TTL = 3600  # TTL для кэша (в секундах)
-CACHE_CLEANUP_INTERVAL = 600  # Интервал очистки кэша (в секундах)
+CACHE_TTL = 3600  # Максимальный TTL записи в кэше (в секундах), меньший TTL берётся из самих записей
+MAX_CACHE_SIZE = 100000  # Максимальное количество записей в кэше
+MAX_CACHE_BYTES = 64 * 1024 * 1024  # Максимальный объём памяти под кэш (в байтах)
+NEGATIVE_CACHE_TTL = 900  # Максимальный срок хранения отрицательных ответов NXDOMAIN и NODATA (в секундах)
+CACHE_POLICY = 'lru'  # Политика вытеснения: 'lru' (давно не используемые) или 'lfu' (редко используемые)
+CACHE_CLEANUP_INTERVAL = 600  # Интервал вывода статистики кэша (в секундах)
+CACHE_EXPIRE_INTERVAL = 1  # Как часто удалять из кэша истёкшие записи (в секундах)
+CACHE_EXPIRE_BATCH = 1000  # Сколько записей удалять за одно взятие блокировки кэша
 MAX_WORKERS = 50  # Максимальное количество потоков
+UDP_PAYLOAD_SIZE = 1232  # Максимальный размер ответа по UDP (EDNS0); более длинный ответ клиент получает по TCP
+TCP_IDLE_TIMEOUT = 10  # Сколько секунд держать открытым простаивающее TCP-соединение клиента
+TCP_MAX_PIPELINE = 100  # Максимум одновременно обрабатываемых запросов в одном TCP-соединении клиента
+TCP_MAX_CLIENTS = 256  # Максимум открытых TCP-соединений клиентов; лишние закрываются сразу, чтобы хватило дескрипторов сокетам к DNS-серверам
+UPSTREAM_TCP_CONNECTIONS = 2  # Количество постоянных TCP-соединений к каждому DNS серверу для длинных ответов
+UPSTREAM_TLS_CONNECTIONS = 2  # Количество постоянных соединений к каждому DoT/DoH-серверу (tls:// и https:// в DNS_SERVERS)
+UPSTREAM_KEEPALIVE = 15  # Через сколько секунд простоя DoT/DoH-соединение поддерживается запросом, 0 - не поддерживать
+UPSTREAM_CA_FILE = None  # Файл корневых сертификатов для проверки DoT/DoH-серверов, None - системные
+UPSTREAM_SOCKETS = 4  # Количество постоянных сокетов на каждый DNS сервер (разные исходные порты)
+HEDGE_PERCENTILE = 0.9  # Перцентиль RTT сервера, после которого запрос дублируется следующему серверу
+HEDGE_MAX = 2  # Максимум дублирующих запросов к другим серверам
+HEDGE_MIN_DELAY = 0.01  # Минимальная задержка перед дублирующим запросом (в секундах)
+UPSTREAM_MAX_FAILURES = 3  # Неудач подряд, после которых сервер считается недоступным
+UPSTREAM_BACKOFF = 1.0  # Начальная пауза для недоступного сервера (в секундах), удваивается до UPSTREAM_MAX_BACKOFF
+UPSTREAM_MAX_BACKOFF = 60.0
+UPSTREAM_PROBE_INTERVAL = 30.0  # Как часто проверять серверы, которым давно не отправлялись запросы (в секундах)
+PREFETCH_THRESHOLD = 0.9  # Доля TTL, после которой популярная запись обновляется заранее
+PREFETCH_MIN_HITS = 10  # Сколько обращений нужно записи, чтобы её обновляли заранее
+STALE_MAX_AGE = 86400  # Сколько секунд после истечения TTL отдавать устаревший ответ (RFC 8767), 0 - не отдавать
+STALE_TTL = 30  # TTL записей в устаревшем ответе
+REFRESH_RETRY_INTERVAL = 30  # Пауза между попытками обновить одну и ту же запись в фоне (в секундах)
+SNAPSHOT_FILE = 'lumindns.cache'  # Файл снимка кэша для быстрого перезапуска, None - не сохранять
+SNAPSHOT_INTERVAL = 300  # Интервал сохранения снимка кэша (в секундах)
+SERVER_MODE = 'threads'  # Режим работы сервера: 'threads' (пул потоков), 'asyncio' (цикл событий) или 'batch' (пачки пакетов)
+BATCH_SIZE = 64  # Сколько пакетов режим 'batch' вычитывает из сокета за одно пробуждение
+WORKERS = 1  # Количество рабочих процессов на общем порту (SO_REUSEPORT); при WORKERS > 1 кэш общий
+SHARED_CACHE_SLOT_SIZE = 1024  # Размер ячейки общего кэша (в байтах); более длинные ответы не кэшируются
+SHARED_CACHE_WAYS = 8  # Количество ячеек в корзине общего кэша
+ALLOW_NETWORKS = None  # Сети клиентов, которым разрешены запросы, например ['192.168.0.0/16', 'fd00::/8']; None - всем
+DENY_NETWORKS = []  # Сети клиентов, запросы которых отбрасываются; решает самое точное из правил ALLOW_NETWORKS и DENY_NETWORKS
+CLIENT_RATE = 0  # Запросов в секунду от одного клиента, 0 - без ограничения
+CLIENT_BURST = 100  # Сколько запросов клиент может прислать разом сверх CLIENT_RATE
+RRL_RATE = 0  # Одинаковых ответов в секунду одной сети клиентов (/24 или /56) по UDP, 0 - без ограничения
+RRL_SLIP = 2  # Каждый RRL_SLIP-й подавленный ответ отправляется пустым с флагом TC, 0 - отбрасывать все
+RATE_LIMIT_CLIENTS = 100000  # Максимум записей в таблицах ограничения скорости
+POLICY_FILE = 'lumindns.policy'  # Скомпилированные блок-листы и переопределения имён (--compile-policy), None - без них
+POLICY_BLOCK_MODE = 'nxdomain'  # Ответ на заблокированное имя: 'nxdomain' или 'zero' (0.0.0.0 и ::)
+POLICY_TTL = 60  # TTL ответов из блок-листов и переопределений
+POLICY_RELOAD_INTERVAL = 10  # Как часто проверять, не заменён ли файл политики (в секундах)
+METRICS_ADDRESS = '127.0.0.1'  # Адрес HTTP-сервера метрик
+METRICS_PORT = 9153  # Порт метрик в формате Prometheus (/metrics), None - не запускать; рабочий процесс N - порт METRICS_PORT + N
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)  # Корзины гистограмм времени (в секундах)
+STAGE_TIMING = False  # Измерять время каждого этапа обработки запроса (разбор, кэш, DNS-серверы, отправка)
+QUERY_LOG_FILE = None  # Двоичный журнал запросов, например 'lumindns.qlog', None - не вести; рабочий процесс N пишет в файл с суффиксом -N
+QUERY_LOG_BUFFER = 131072  # Сколько записей журнала может ждать записи на диск; не поместившиеся отбрасываются и считаются
+QUERY_LOG_FLUSH_INTERVAL = 0.5  # Как часто записывать накопленные записи журнала на диск (в секундах)
+QUERY_LOG_MAX_BYTES = 64 * 1024 * 1024  # Размер файла журнала, после которого он переименовывается в .1 и начинается новый
+QUERY_LOG_BACKUPS = 10  # Сколько старых файлов журнала хранить (.1 - самый новый)
+CAPTURE_FILE = None  # Файл захвата входящих запросов для воспроизведения в dnsreplay.py, None - не захватывать; ротируется как журнал запросов
+LISTEN_ADDRESS = ''  # Адрес, на котором сервер принимает запросы
+LISTEN_PORT = 53
 
-# Сокет сервера
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-server_socket.bind(('', 53))
-
-# Кэш запросов
-cache = {}
-selector = selectors.DefaultSelector()
+# Сокеты сервера: UDP и TCP
+server_socket = None
+tcp_socket = None
 
 # Ответ при ошибке
 ERROR_RESPONSE = struct.pack("!6H", 0, 0, 3, 0, 1, 0) + struct.pack("!4H", 0, 0, 0, 0)
 
-# Извлечение домена из DNS-запроса
-def extract_domain(data):
+# Метрики в формате Prometheus. Счётчики и гистограммы ведутся без блокировок:
+# каждый поток пишет в свой набор, а при выдаче наборы всех потоков суммируются
+class Metrics:
+    BUCKET_LABELS = [f'{bound:g}' for bound in LATENCY_BUCKETS] + ['+Inf']
+
+    def __init__(self):
+        self.local = local()
+        self.shards = []
+        self.lock = Lock()
+
+    # Набор текущего потока: счётчики {(имя, метки): значение} и гистограммы {(имя, метки): [корзины..., +Inf, сумма]}
+    def shard(self):
+        if not hasattr(self.local, 'counters'):
+            self.local.counters = {}
+            self.local.histograms = {}
+            with self.lock:
+                self.shards.append((self.local.counters, self.local.histograms))
+        return self.local
+
+    def count(self, name, labels='', value=1):
+        counters = self.shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, seconds, labels=''):
+        try:
+            histogram = self.local.histograms[name, labels]
+        except (AttributeError, KeyError):
+            histogram = self.shard().histograms.setdefault((name, labels), [0] * (len(LATENCY_BUCKETS) + 2))
+        histogram[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        histogram[-1] += seconds
+
+    # Время этапа обработки запроса, начавшегося в since; возвращает начало следующего этапа
+    def stage(self, name, since):
+        now = time.perf_counter()
+        self.observe('dns_stage_duration_seconds', now - since, f'stage="{name}"')
+        return now
+
+    # Текст для /metrics: значения, вычисленные в момент запроса (gauges, totals), и накопленные в потоках
+    def render(self, gauges, totals):
+        counters = dict(totals)
+        histograms = {}
+        with self.lock:
+            shards = list(self.shards)
+        for shard_counters, shard_histograms in shards:
+            for key, value in list(shard_counters.items()):
+                counters[key] = counters.get(key, 0) + value
+            for key, histogram in list(shard_histograms.items()):
+                total = histograms.setdefault(key, [0] * len(histogram))
+                for i, value in enumerate(list(histogram)):
+                    total[i] += value
+        lines = []
+        for kind, values in (('gauge', gauges), ('counter', counters), ('histogram', histograms)):
+            current = None
+            for (name, labels), value in sorted(values.items()):
+                if name != current:
+                    lines.append(f'# TYPE {name} {kind}')
+                    current = name
+                suffix = f'{{{labels}}}' if labels else ''
+                if kind != 'histogram':
+                    lines.append(f'{name}{suffix} {value}')
+                    continue
+                prefix = labels + ',' if labels else ''
+                cumulative = 0
+                for bound, count in zip(self.BUCKET_LABELS, value):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{suffix} {value[-1]}')
+                lines.append(f'{name}_count{suffix} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+# Журнал запросов. Обслуживающие потоки только кладут кортеж в очередь ограниченного размера,
+# а фоновый поток раз в QUERY_LOG_FLUSH_INTERVAL упаковывает накопившиеся записи и пишет их
+# в файл одним вызовом. Файл: заголовок со списком DNS-серверов, затем записи подряд -
+# фиксированная часть (время, длительность, адрес и порт клиента, QTYPE, RCODE, результат,
+# флаги, номер DNS-сервера, длина имени) и имя из вопроса в wire-формате
+class QueryLog:
+    MAGIC = b'LDNSQLOG'
+    VERSION = 1
+    HEADER = struct.Struct('!8sHB')
+    RECORD = struct.Struct('!df16sHHBBBBB')
+    RESULTS = ('hit', 'miss', 'policy', 'error')
+    TITLE = 'журнал запросов'
+    DROPPED = 'dns_query_log_dropped_total'
+    # Флаги записи
+    TCP = 1
+    IPV6 = 2
+    # Номер DNS-сервера для ответов, полученных не от DNS-сервера
+    NO_UPSTREAM = 255
+
+    def __init__(self, path, servers=None):
+        self.path = path
+        # None - текущий DNS_SERVERS, который мог заменить --servers
+        self.servers = list(DNS_SERVERS if servers is None else servers)
+        self.upstreams = {server: i for i, server in enumerate(self.servers)}
+        self.records = deque()
+        self.capacity = QUERY_LOG_BUFFER
+        self.file = None
+        self.written = 0
+        self.rotations = 0
+        # Метки запроса -> (результат, флаги)
+        self.kinds = {}
+        self.lock = Lock()
+
+    # Запись о запросе; вызывается на каждый запрос, поэтому ничего не упаковывает
+    def add(self, latency, labels, client_address, key, response, upstream=None):
+        if len(self.records) < self.capacity:
+            self.records.append((time.time(), latency, labels, client_address, key, response, upstream))
+        else:
+            metrics.count(self.DROPPED)
+
+    def kind(self, labels):
+        kind = self.kinds.get(labels)
+        if kind is None:
+            result = labels.rsplit('"', 2)[1]
+            kind = self.kinds[labels] = (self.RESULTS.index(result), self.TCP if 'tcp' in labels else 0)
+        return kind
+
+    # Запись накопившихся записей в файл
+    def flush(self):
+        with self.lock:
+            count = len(self.records)
+            if not count:
+                return
+            records = [self.records.popleft() for _ in range(count)]
+            try:
+                data = self.pack(records)
+            except Exception:
+                # Одна испорченная запись не должна губить всю пачку: пакуем по одной, испорченные отбрасываем
+                chunks = []
+                for record in records:
+                    try:
+                        chunks.append(self.pack([record]))
+                    except Exception:
+                        metrics.count(self.DROPPED)
+                        count -= 1
+                data = b''.join(chunks)
+            try:
+                self.write(data)
+            except Exception:
+                metrics.count(self.DROPPED, value=count)
+                raise
+            self.written += count
+
+    # Упаковка пачки записей в формат файла
+    def pack(self, records):
+        chunks = []
+        for timestamp, latency, labels, client_address, key, response, upstream in records:
+            result, flags = self.kind(labels)
+            host, port = client_address[:2] if client_address else ('0.0.0.0', 0)
+            if ':' in host:
+                address = socket.inet_pton(socket.AF_INET6, host)
+                flags |= self.IPV6
+            else:
+                address = socket.inet_aton(host)
+            qname, qtype = (key[0], key[1]) if key else (b'', 0)
+            rcode = response[3] & 0x0F if response and result != 3 else 2
+            chunks.append(self.RECORD.pack(timestamp, latency, address, port, qtype, rcode, result, flags,
+                                           self.upstreams.get(upstream, self.NO_UPSTREAM), len(qname)))
+            chunks.append(qname)
+        return b''.join(chunks)
+
+    # Заголовок файла со списком DNS-серверов
+    def header(self):
+        names = b''.join(bytes((len(server.encode()),)) + server.encode() for server in self.servers)
+        return self.HEADER.pack(self.MAGIC, self.VERSION, len(self.servers)) + names
+
+    def write(self, data):
+        if self.file is None:
+            # Каждый файл начинается со своего заголовка, поэтому файл прошлого запуска ротируется
+            if os.path.exists(self.path) and os.path.getsize(self.path):
+                self.rotate()
+            self.file = open(self.path, 'wb')
+            self.file.write(self.header())
+        self.file.write(data)
+        self.file.flush()
+        if self.file.tell() >= QUERY_LOG_MAX_BYTES:
+            self.file.close()
+            self.file = None
+            self.rotate()
+
+    # Ротация: журнал -> .1, .1 -> .2 и так далее; самый старый файл удаляется
+    def rotate(self):
+        for i in range(QUERY_LOG_BACKUPS - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{i}'):
+                os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+        if QUERY_LOG_BACKUPS:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+        self.rotations += 1
+
+    def run(self):
+        while True:
+            time.sleep(QUERY_LOG_FLUSH_INTERVAL)
+            # Поток записи не должен останавливаться ни при какой ошибке, иначе журнал молча прекратится
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Не удалось записать {self.TITLE} {self.path}: {e}")
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    # Чтение файла журнала: словари с полями записей; недописанная последняя запись пропускается
+    @classmethod
+    def read(cls, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, version, count = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError(f"{path}: неизвестный формат журнала запросов")
+        i = cls.HEADER.size
+        servers = []
+        for _ in range(count):
+            servers.append(data[i + 1:i + 1 + data[i]].decode())
+            i += 1 + data[i]
+        while i + cls.RECORD.size <= len(data):
+            (timestamp, latency, address, port, qtype, rcode, result, flags,
+             upstream, length) = cls.RECORD.unpack_from(data, i)
+            i += cls.RECORD.size
+            if i + length > len(data):
+                break
+            qname = data[i:i + length]
+            i += length
+            labels = []
+            j = 0
+            while j < len(qname) and qname[j]:
+                labels.append(qname[j + 1:j + 1 + qname[j]].decode('ascii', 'replace'))
+                j += 1 + qname[j]
+            yield {
+                'time': timestamp,
+                'client': socket.inet_ntop(socket.AF_INET6, address) if flags & cls.IPV6 else socket.inet_ntoa(address[:4]),
+                'port': port,
+                'transport': 'tcp' if flags & cls.TCP else 'udp',
+                'qname': '.'.join(labels) + '.',
+                'qtype': qtype,
+                'rcode': rcode,
+                'result': cls.RESULTS[result],
+                'latency': latency,
+                'upstream': servers[upstream] if upstream < len(servers) else '',
+            }
+
+# Захват входящих запросов для воспроизведения: время прихода и запрос целиком, как он пришёл.
+# Записи копятся и пишутся на диск так же, как записи журнала запросов.
+# Файл: заголовок, затем записи подряд - время, длина запроса и сам запрос
+class QueryCapture(QueryLog):
+    MAGIC = b'LDNSCAPT'
+    VERSION = 1
+    HEADER = struct.Struct('!8sH')
+    RECORD = struct.Struct('!dH')
+    TITLE = 'захват запросов'
+    DROPPED = 'dns_capture_dropped_total'
+
+    def __init__(self, path):
+        super().__init__(path, [])
+
+    def add(self, data):
+        if len(self.records) < self.capacity:
+            self.records.append((time.time(), data))
+        else:
+            metrics.count(self.DROPPED)
+
+    def pack(self, records):
+        chunks = []
+        for timestamp, data in records:
+            chunks.append(self.RECORD.pack(timestamp, len(data)))
+            chunks.append(data)
+        return b''.join(chunks)
+
+    def header(self):
+        return self.HEADER.pack(self.MAGIC, self.VERSION)
+
+    # Чтение файла захвата: (время, запрос); недописанная последняя запись пропускается
+    @classmethod
+    def read(cls, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, version = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError(f"{path}: неизвестный формат захвата запросов")
+        i = cls.HEADER.size
+        while i + cls.RECORD.size <= len(data):
+            timestamp, length = cls.RECORD.unpack_from(data, i)
+            i += cls.RECORD.size
+            if i + length > len(data):
+                break
+            yield timestamp, data[i:i + length]
+            i += length
+
+# Журнал и захват запросов текущего процесса, None - не ведутся
+query_log = None
+capture = None
+
+# Учёт обработанного запроса: общее время с start и, при STAGE_TIMING, время отправки ответа с mark.
+# Запрос записывается в журнал, если он ведётся
+def finish_request(start, mark, labels, client_address=None, key=None, response=None, upstream=None):
+    now = time.perf_counter()
+    if STAGE_TIMING:
+        metrics.observe('dns_stage_duration_seconds', now - mark, 'stage="send"')
+    metrics.observe('dns_request_duration_seconds', now - start, labels)
+    if query_log is not None:
+        query_log.add(now - start, labels, client_address, key, response, upstream)
+
+# Смещение конца секции вопроса (после QTYPE и QCLASS)
+def question_end(data):
     try:
-        domain_parts = []
         i = 12
         while data[i] != 0:
-            length = data[i]
-            domain_parts.append(data[i + 1:i + 1 + length].decode())
+            i += data[i] + 1
+        return i + 5
+    except IndexError:
+        return None
+
+# Пропуск доменного имени (с учётом указателей сжатия)
+def skip_name(data, i):
+    while True:
+        length = data[i]
+        if length == 0:
+            return i + 1
+        if length & 0xC0 == 0xC0:
+            return i + 2
+        i += length + 1
+
+# Заранее разобранные форматы полей, которые читаются на каждый запрос
+QUESTION_FIELDS = struct.Struct('!HH')
+RECORD_FIELDS = struct.Struct('!HHIH')
+TTL_FIELD = struct.Struct('!I')
+
+# Ключ кэша для DNS-запроса: (имя в нижнем регистре, QTYPE, QCLASS, бит DO).
+# Заголовок и вопрос разбираются за один проход по длинам меток, без создания
+# строки на каждую метку; единственная копия - имя целиком для ключа
+def parse_query(data):
+    try:
+        i = 12
+        length = data[i]
+        while length:
+            # Указатели сжатия и расширенные метки в вопросе запроса недопустимы
+            if length > 63:
+                return None
             i += length + 1
-        return '.'.join(domain_parts), data[:2]
-    except (IndexError, UnicodeDecodeError):
+            length = data[i]
+        # Имя длиннее 255 байт (RFC 1035) недопустимо
+        if i > 266:
+            return None
+        qtype, qclass = QUESTION_FIELDS.unpack_from(data, i + 1)
+        do_bit = False
+        # Бит DO передаётся в псевдозаписи OPT (EDNS0) в дополнительной секции
+        if data[10] or data[11]:
+            end = i + 5
+            # Обычный случай: единственная дополнительная запись OPT сразу после вопроса
+            if data[6:11] == b'\0\0\0\0\0' and data[11] == 1 and data[end] == 0 and data[end + 2] == 41:
+                do_bit = data[end + 7] & 0x80 != 0
+            else:
+                do_bit = find_do_bit(data, end)
+        name = data[12:i + 1]
+        return (name if name.islower() else name.lower()), qtype, qclass, do_bit
+    except (IndexError, struct.error):
+        return None
+
+# Поиск бита DO среди всех записей запроса после секции вопроса
+def find_do_bit(data, i):
+    answer_count, authority_count, additional_count = struct.unpack_from('!3H', data, 6)
+    do_bit = False
+    for n in range(answer_count + authority_count + additional_count):
+        i = skip_name(data, i)
+        rtype, _, _, rdlength = RECORD_FIELDS.unpack_from(data, i)
+        if rtype == 41 and n >= answer_count + authority_count:
+            do_bit = data[i + 6] & 0x80 != 0
+        i += 10 + rdlength
+    return do_bit
+
+# Смещения полей TTL всех записей ответа и минимальный TTL.
+# Для отрицательного ответа (RFC 2308: NXDOMAIN или пустой раздел ответа) срок хранения
+# берётся из SOA в разделе полномочий: меньшее из её TTL и поля MINIMUM. Без SOA такой ответ не кэшируется
+def parse_ttls(response):
+    try:
+        counts = struct.unpack_from('!3H', response, 6)
+        negative = counts[0] == 0 or response[3] & 0x0F == 3
+        soa = False
+        i = question_end(response)
+        offsets = []
+        min_ttl = None
+        for n in range(sum(counts)):
+            i = skip_name(response, i)
+            rtype, _, ttl, rdlength = struct.unpack_from('!HHIH', response, i)
+            # У псевдозаписи OPT вместо TTL хранятся флаги EDNS0
+            if rtype != 41:
+                offsets.append(i + 4)
+                if negative and rtype == 6 and counts[0] <= n < counts[0] + counts[1]:
+                    minimum, = TTL_FIELD.unpack_from(response, i + 6 + rdlength)
+                    ttl = min(ttl, minimum, NEGATIVE_CACHE_TTL)
+                    soa = True
+                min_ttl = ttl if min_ttl is None else min(min_ttl, ttl)
+            i += 10 + rdlength
+        if i > len(response):
+            return None, None
+        return offsets, (min_ttl if soa or not negative else None)
+    except (TypeError, IndexError, struct.error):
         return None, None
 
-# Запрос к нескольким DNS-серверам с использованием селектора
-def resolve_with_servers(data, servers):
-    responses = {}
-    sockets = {}
+# Ответ с TTL записей, уменьшенными на elapsed секунд
+def age_response(response, ttl_offsets, elapsed):
+    if not elapsed:
+        return response
+    aged = bytearray(response)
+    for offset in ttl_offsets:
+        ttl, = TTL_FIELD.unpack_from(aged, offset)
+        TTL_FIELD.pack_into(aged, offset, ttl - elapsed if ttl > elapsed else 0)
+    return bytes(aged)
+
+# Устаревший ответ (RFC 8767): все TTL заменяются на STALE_TTL
+def stale_response(response, ttl_offsets):
+    stale = bytearray(response)
+    for offset in ttl_offsets:
+        TTL_FIELD.pack_into(stale, offset, STALE_TTL)
+    return bytes(stale)
+
+# Ответ, в котором TTL записей не больше срока хранения в кэше: так TTL SOA
+# отрицательного ответа не превышает её поля MINIMUM (RFC 2308)
+def cap_ttls(response, ttl_offsets, ttl):
+    capped = None
+    for offset in ttl_offsets:
+        if TTL_FIELD.unpack_from(response, offset)[0] > ttl:
+            capped = capped or bytearray(response)
+            TTL_FIELD.pack_into(capped, offset, ttl)
+    return bytes(capped) if capped else response
+
+# Ответ из кэша для клиента. Имя в кэшированном ответе хранится в нижнем регистре,
+# поэтому для такого же запроса достаточно подставить ID; иначе копируем регистр имени из запроса
+def serve_cached(response, data, qname):
+    if data.startswith(qname, 12):
+        return data[:2] + response[2:]
+    end = 12 + len(qname)
+    return data[:2] + response[2:12] + data[12:end] + response[end:]
+
+# Ответ для хранения в кэше: имя в вопросе приводится к нижнему регистру
+def normalize_response(response, qname):
+    if response.startswith(qname, 12):
+        return response
+    return response[:12] + qname + response[12 + len(qname):]
+
+# Проверка ответа DNS-сервера
+def check_response(response, data, server):
+    # Проверка, что ответ соответствует запросу (ID)
+    if response[:2] != data[:2]:
+        metrics.count('dns_upstream_invalid_total', f'server="{server}",reason="id"')
+        return False
+    # Проверка минимальной длины ответа (12 байтов - базовый размер DNS-запроса/ответа)
+    if len(response) <= 12:
+        metrics.count('dns_upstream_invalid_total', f'server="{server}",reason="short"')
+        return False
+    # Пустой ответ годится только с кодом NOERROR (NODATA) или NXDOMAIN; SERVFAIL, REFUSED и прочие
+    # ошибки без записей отбрасываем, чтобы дождаться ответа другого сервера
+    answer_count = struct.unpack('!H', response[6:8])[0]
+    if answer_count == 0 and response[3] & 0x0F not in (0, 3):
+        metrics.count('dns_upstream_invalid_total', f'server="{server}",reason="rcode{response[3] & 0x0F}"')
+        return False
+    return True
+
+# Размер UDP-ответа, объявленный клиентом в записи OPT (RFC 6891), но не больше UDP_PAYLOAD_SIZE;
+# 0 - в запросе нет записи OPT
+def edns_payload_size(data):
     try:
-        # Создание сокетов для каждого сервера
-        for server in servers:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.setblocking(False)
-            sock.sendto(data, (server, 53))  # Отправка запроса на DNS сервер
-            selector.register(sock, selectors.EVENT_READ, server)
-            sockets[server] = sock
-
-        start_time = time.time()
-        while time.time() - start_time < DNS_TIMEOUT:
-            events = selector.select(timeout=DNS_TIMEOUT)
-            for key, _ in events:
-                sock = key.fileobj
-                server = key.data
-                try:
-                    response, _ = sock.recvfrom(1024)
-                    
-                    # Проверка, что ответ соответствует запросу (ID)
-                    if response[:2] == data[:2]:  
-                        # Проверка минимальной длины ответа (12 байтов - базовый размер DNS-запроса/ответа)
-                        if len(response) > 12:
-                            # Дополнительные проверки, например, на правильность формата DNS-ответа
-                            # Проверим наличие записей в ответе (например, для A-записей)
-                            answer_count = struct.unpack('!H', response[6:8])[0]
-                            if answer_count > 0:
-                                return response
-                            else:
-                                print(f"Ответ от {server} не содержит записей")
-                        else:
-                            print(f"Некорректный ответ от {server}: данные слишком короткие")
-                    else:
-                        print(f"Ответ от {server} не совпадает с запросом: {response[:2]} != {data[:2]}")
-                
-                except socket.timeout:
-                    print(f"Тайм-аут при ожидании ответа от {server}")
-                    continue
-                except socket.error as e:
-                    print(f"Ошибка сокета от {server}: {e}")
-                    continue
-                except Exception as e:
-                    print(f"Неизвестная ошибка при обработке ответа от {server}: {e}")
+        i = question_end(data)
+        for _ in range(sum(struct.unpack_from('!3H', data, 6))):
+            i = skip_name(data, i)
+            rtype, size, _, rdlength = RECORD_FIELDS.unpack_from(data, i)
+            if rtype == 41:
+                return min(max(size, 512), UDP_PAYLOAD_SIZE)
+            i += 10 + rdlength
+    except (TypeError, IndexError, struct.error):
+        pass
+    return 0
+
+# Ответ клиенту по UDP. Если ответ не помещается в 512 байтов или в размер из EDNS0,
+# отправляем только вопрос с флагом TC, и клиент повторит запрос по TCP.
+# При RRL_RATE ответ может быть подавлен (None) или усечён
+def udp_response(response, data, key, client_address):
+    if RRL_RATE:
+        response = access.limit_response(response, data, key, client_address)
+        if response is None:
+            return None
+    size = edns_payload_size(data)
+    if len(response) <= max(size, 512):
+        return response
+    return truncated_response(response, size)
+
+# Ответ только с вопросом и флагом TC; с записью OPT, если она была в запросе (size не 0)
+def truncated_response(response, size):
+    end = question_end(response)
+    header = response[:2] + bytes((response[2] | 0x02, response[3])) + struct.pack('!4H', 1, 0, 0, 1 if size else 0)
+    opt = b'\0' + RECORD_FIELDS.pack(41, UDP_PAYLOAD_SIZE, 0, 0) if size else b''
+    return header + response[12:end] + opt
+
+# Разбор адреса DNS-сервера: '1.1.1.1', '127.0.0.1:5300' или '[::1]:5300'
+def parse_server(server, port=53):
+    if server.startswith('['):
+        host, _, server_port = server[1:].partition(']:')
+        return host.rstrip(']'), int(server_port or port)
+    if server.count(':') == 1:
+        host, server_port = server.split(':')
+        return host, int(server_port)
+    return server, port
+
+# Разбор адреса DoT/DoH-сервера: (адрес, порт, имя в сертификате, путь запросов DoH)
+def parse_secure_server(server):
+    scheme, _, server = server.partition('://')
+    server, _, name = server.partition('#')
+    server, _, path = server.partition('/')
+    host, port = parse_server(server, 443 if scheme == 'https' else 853)
+    return host, port, name or host, '/' + (path or 'dns-query')
+
+# Статистика DNS-сервера: сглаженное RTT, доля потерь и SERVFAIL, пауза после неудач
+class UpstreamStats:
+    ALPHA = 0.05  # Вес нового значения в EWMA для долей потерь и SERVFAIL
+    SAMPLES = 64  # Сколько последних RTT хранить для расчёта перцентиля
+
+    def __init__(self):
+        # Пока ответов не было, RTT считаем пессимистично: сервер сначала получит пробный запрос
+        self.srtt = DNS_TIMEOUT / 4
+        self.rttvar = 0.0
+        self.loss = 0.0
+        self.servfail = 0.0
+        self.samples = deque(maxlen=self.SAMPLES)
+        self.replies = 0
+        self.hedge_delay = DNS_TIMEOUT / 4
+        self.failures = 0
+        self.backoff = 0.0
+        self.retry_at = 0.0
+        self.last_used = 0.0
+
+    # Ответ получен за rtt секунд; failed - сервер ответил SERVFAIL или REFUSED
+    def record_reply(self, rtt, failed, now):
+        if self.replies:
+            self.rttvar += (abs(rtt - self.srtt) - self.rttvar) / 4
+            self.srtt += (rtt - self.srtt) / 8
+        else:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        self.replies += 1
+        self.samples.append(rtt)
+        if self.replies % 16 == 1:
+            ordered = sorted(self.samples)
+            self.hedge_delay = max(ordered[int(len(ordered) * HEDGE_PERCENTILE)], HEDGE_MIN_DELAY)
+        self.loss -= self.loss * self.ALPHA
+        self.servfail += (failed - self.servfail) * self.ALPHA
+        if failed:
+            self.record_failure(now)
+        else:
+            self.failures = 0
+            self.backoff = 0.0
+
+    def record_loss(self, now):
+        self.loss += (1 - self.loss) * self.ALPHA
+        self.record_failure(now)
+
+    def record_failure(self, now):
+        self.failures += 1
+        if self.failures >= UPSTREAM_MAX_FAILURES:
+            self.backoff = min(max(self.backoff * 2, UPSTREAM_BACKOFF), UPSTREAM_MAX_BACKOFF)
+            self.retry_at = now + self.backoff
+
+    @property
+    def healthy(self):
+        return self.failures < UPSTREAM_MAX_FAILURES
+
+    # Чем меньше, тем лучше: RTT с поправкой на потери и SERVFAIL
+    def score(self):
+        return (self.srtt + 4 * self.rttvar) * (1 + 4 * self.loss + 4 * self.servfail)
+
+    # Нужен ли серверу пробный запрос: недоступному - по истечении паузы, остальным - если давно не использовался
+    def probe_due(self, now):
+        if not self.healthy:
+            if now < self.retry_at:
+                return False
+            self.retry_at = now + self.backoff
+            return True
+        if now - self.last_used < UPSTREAM_PROBE_INTERVAL:
+            return False
+        self.last_used = now
+        return True
+
+# TCP-соединение к DNS-серверу. Запросы идут конвейером, не дожидаясь ответов на предыдущие;
+# ответы сопоставляются с запросами по ID транзакции и вопросу
+class UpstreamConnection:
+    def __init__(self, pool):
+        self.pool = pool
+        self.writer = None
+        # (ID транзакции, вопрос) -> future
+        self.pending = {}
+        # Сервер предупредил, что закроет соединение после этого ответа
+        self.closing = False
+        loop = asyncio.get_running_loop()
+        self.last_used = loop.time()
+        self.opened = loop.create_future()
+        self.task = loop.create_task(self.run())
+
+    async def run(self):
+        try:
+            reader, self.writer = await asyncio.wait_for(self.pool.connect(), DNS_TIMEOUT)
+            self.pool.connected(self.writer)
+            self.opened.set_result(True)
+            answered = False
+            while not self.closing:
+                response = await self.read_message(reader)
+                if response is None:
                     continue
+                end = question_end(response)
+                future = self.pending.pop((response[:2], response[12:end]), None)
+                if future and not future.done():
+                    future.set_result(response)
+                # Билет для возобновления сессии TLS 1.3 сервер присылает уже после рукопожатия
+                if not answered:
+                    answered = True
+                    self.pool.answered(self.writer)
+        except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+            pass
+        finally:
+            self.pool.connections.remove(self)
+            if not self.opened.done():
+                self.opened.set_result(False)
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_result(None)
+            if self.writer:
+                self.writer.close()
 
-    except Exception as e:
-        print(f"Ошибка при запросе к серверам: {e}")
-    
-    finally:
-        # Закрытие всех сокетов
-        for sock in sockets.values():
-            try:
-                selector.unregister(sock)
-                sock.close()
-            except socket.error as e:
-                print(f"Ошибка при закрытии сокета: {e}")
+    # Отправка запроса с подменённым ID; ответ или None, если соединение закрылось или ответа нет дольше DNS_TIMEOUT.
+    # Запрос учитывается в pending ещё до открытия соединения, чтобы пул видел его занятым
+    async def query(self, data):
+        end = question_end(data)
+        while True:
+            txid = random.getrandbits(16).to_bytes(2, 'big')
+            key = (txid, data[12:end])
+            if key not in self.pending:
+                break
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending[key] = future
+        try:
+            if not await asyncio.shield(self.opened):
+                return None
+            self.last_used = loop.time()
+            self.writer.write(self.frame(txid + data[2:]))
+            return await asyncio.wait_for(future, DNS_TIMEOUT)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self.pending.pop(key, None)
+
+    # Сообщение DNS с префиксом длины (RFC 1035, 4.2.2)
+    def frame(self, message):
+        return struct.pack('!H', len(message)) + message
+
+    async def read_message(self, reader):
+        length, = struct.unpack('!H', await reader.readexactly(2))
+        return await reader.readexactly(length)
 
-    print("Не удалось получить корректный ответ от серверов.")
+    def close(self):
+        self.task.cancel()
+
+# Соединение к DoH-серверу (RFC 8484): HTTP/1.1 с keep-alive, запросы POST идут конвейером.
+# Ответ DNS внутри HTTP-ответа содержит ID транзакции, поэтому сопоставление то же, что и у TCP
+class HTTPSConnection(UpstreamConnection):
+    def __init__(self, pool):
+        # Ключи отправленных запросов в порядке отправки: HTTP/1.1 отвечает в том же порядке
+        self.sent = deque()
+        super().__init__(pool)
+
+    def frame(self, message):
+        self.sent.append((message[:2], message[12:question_end(message)]))
+        return (f'POST {self.pool.path} HTTP/1.1\r\nHost: {self.pool.name}\r\n'
+                f'Content-Type: application/dns-message\r\nAccept: application/dns-message\r\n'
+                f'Content-Length: {len(message)}\r\n\r\n').encode() + message
+
+    # Тело очередного HTTP-ответа. Если сервер ответил не 200, запрос, к которому относится
+    # ответ, сразу завершается неудачей, а не ждёт DNS_TIMEOUT, и возвращается None
+    async def read_message(self, reader):
+        lines = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+        status = int(lines[0].split()[1])
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip().lower()
+        if 'chunked' in headers.get('transfer-encoding', ''):
+            chunks = []
+            while True:
+                size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                chunks.append((await reader.readexactly(size + 2))[:-2])
+                if not size:
+                    break
+            body = b''.join(chunks)
+        else:
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+        self.closing = headers.get('connection') == 'close'
+        key = self.sent.popleft() if self.sent else None
+        if status == 200 and len(body) > 12:
+            return body
+        future = self.pending.pop(key, None)
+        if future and not future.done():
+            future.set_result(None)
+        return None
+
+# Пул постоянных TCP-соединений к DNS-серверу для ответов, не поместившихся в UDP (флаг TC).
+# Новое соединение открывается, только если все открытые заняты и пул не заполнен
+class UpstreamTCP:
+    connection_class = UpstreamConnection
+
+    def __init__(self, server):
+        self.server = server
+        self.size = UPSTREAM_TCP_CONNECTIONS
+        self.connections = []
+
+    async def connect(self):
+        return await asyncio.open_connection(*parse_server(self.server))
+
+    # Вызываются соединением после подключения и после первого ответа
+    def connected(self, writer):
+        pass
+
+    def answered(self, writer):
+        pass
+
+    async def query(self, data):
+        response = await self.exchange(data)
+        if response is not None and check_response(response, data, self.server):
+            return response
+        return None
+
+    # Ответ сервера с ID из запроса, без проверки; None, если ответа нет
+    async def exchange(self, data):
+        # Сервер мог закрыть простаивавшее соединение, поэтому при обрыве пробуем ещё раз на новом
+        for _ in range(2):
+            connection = min(self.connections, key=lambda connection: len(connection.pending), default=None)
+            if connection is None or (connection.pending and len(self.connections) < self.size):
+                connection = self.open()
+            response = await connection.query(data)
+            if response is not None:
+                return data[:2] + response[2:]
+            if connection in self.connections:
+                break
+        return None
+
+    def open(self):
+        connection = self.connection_class(self)
+        self.connections.append(connection)
+        return connection
+
+    def close(self):
+        for connection in list(self.connections):
+            connection.close()
+
+# Контекст TLS, возобновляющий последнюю сессию сервера: asyncio не позволяет передать
+# сессию при подключении, поэтому она подставляется при создании объекта TLS
+class ResumingContext(ssl.SSLContext):
+    session = None
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session or self.session)
+
+# Пул постоянных соединений DNS-over-TLS (RFC 7858) к серверу 'tls://...': запросы идут конвейером,
+# новые соединения возобновляют сессию TLS без полного рукопожатия, а простаивающие соединения
+# поддерживаются запросом раз в UPSTREAM_KEEPALIVE секунд, чтобы сервер их не закрыл
+class UpstreamTLS(UpstreamTCP):
+    ALPN = 'dot'
+    # Запрос для поддержки соединения: NS корневой зоны
+    KEEPALIVE_QUERY = struct.pack('!6H', 0, 0x0100, 1, 0, 0, 0) + b'\0' + struct.pack('!HH', 2, 1)
+
+    def __init__(self, server):
+        super().__init__(server)
+        self.size = UPSTREAM_TLS_CONNECTIONS
+        self.host, self.port, self.name, self.path = parse_secure_server(server)
+        self.context = ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+        if UPSTREAM_CA_FILE:
+            self.context.load_verify_locations(UPSTREAM_CA_FILE)
+        else:
+            self.context.load_default_certs()
+        self.context.set_alpn_protocols([self.ALPN])
+        self.labels = f'server="{server}"'
+
+    async def connect(self):
+        return await asyncio.open_connection(self.host, self.port, ssl=self.context, server_hostname=self.name)
+
+    def connected(self, writer):
+        ssl_object = writer.get_extra_info('ssl_object')
+        metrics.count('dns_upstream_tls_handshakes_total', self.labels)
+        if ssl_object.session_reused:
+            metrics.count('dns_upstream_tls_resumed_total', self.labels)
+        self.context.session = ssl_object.session
+
+    def answered(self, writer):
+        self.context.session = writer.get_extra_info('ssl_object').session
+
+    async def keepalive(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(UPSTREAM_KEEPALIVE / 2)
+            if not self.connections:
+                self.open()
+            idle = [connection for connection in self.connections
+                    if not connection.pending and loop.time() - connection.last_used >= UPSTREAM_KEEPALIVE]
+            await asyncio.gather(*(connection.query(self.KEEPALIVE_QUERY) for connection in idle))
+
+# Пул соединений DNS-over-HTTPS к серверу 'https://...'. Библиотеки HTTP/2 в стандартной
+# библиотеке нет, поэтому используется HTTP/1.1: несколько постоянных соединений с конвейером запросов
+class UpstreamHTTPS(UpstreamTLS):
+    ALPN = 'http/1.1'
+    connection_class = HTTPSConnection
+
+# Канал к DoT/DoH-серверу с тем же интерфейсом, что у UDP-канала: запросы идут через пул
+# постоянных соединений, а RTT, потери и SERVFAIL учитываются так же, как для UDP
+class UpstreamStream:
+    def __init__(self, server):
+        self.server = server
+        self.stats = UpstreamStats()
+        self.labels = f'server="{server}"'
+        self.tcp = (UpstreamHTTPS if server.startswith('https://') else UpstreamTLS)(server)
+        # Единственный транспорт канала - пул соединений
+        self.transports = []
+        self.tasks = set()
+
+    # Первое соединение открывается сразу, чтобы первый запрос не ждал рукопожатия
+    async def open(self, count):
+        self.transports.append(self.tcp)
+        self.tcp.open()
+        if UPSTREAM_KEEPALIVE:
+            self.start(self.tcp.keepalive())
+
+    def close(self):
+        self.transports.clear()
+        for task in list(self.tasks):
+            task.cancel()
+        self.tcp.close()
+
+    def start(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    # Отправка запроса. Возвращает задачу с проверенным ответом или None (ошибка, потеря)
+    def send(self, data):
+        if question_end(data) is None or not self.transports:
+            return None
+        self.stats.last_used = asyncio.get_running_loop().time()
+        return self.start(self.query(data))
+
+    async def query(self, data):
+        loop = asyncio.get_running_loop()
+        sent = loop.time()
+        response = await self.tcp.exchange(data)
+        now = loop.time()
+        if response is None:
+            self.stats.record_loss(now)
+            metrics.count('dns_upstream_timeouts_total', self.labels)
+            return None
+        self.stats.record_reply(now - sent, len(response) > 3 and response[3] & 0x0F in (2, 5), now)
+        metrics.observe('dns_upstream_rtt_seconds', now - sent, self.labels)
+        return response if check_response(response, data, self.server) else None
+
+# Постоянный канал к DNS-серверу: несколько долгоживущих UDP-сокетов,
+# подмена ID транзакции и таблица ожидающих запросов
+class UpstreamChannel(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+        self.transports = []
+        self.stats = UpstreamStats()
+        # (ID транзакции, вопрос) -> (future, исходный запрос клиента, время отправки, таймер потери)
+        self.pending = {}
+        self.tcp = UpstreamTCP(server)
+        self.tasks = set()
+        self.labels = f'server="{server}"'
+
+    async def open(self, count):
+        loop = asyncio.get_running_loop()
+        for _ in range(count):
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: self, remote_addr=parse_server(self.server))
+            self.transports.append(transport)
+
+    def close(self):
+        for transport in self.transports:
+            transport.close()
+        self.transports.clear()
+        self.tcp.close()
+
+    # Отправка запроса. Возвращает future с проверенным ответом или None (ошибка, потеря)
+    def send(self, data):
+        end = question_end(data)
+        if end is None or not self.transports:
+            return None
+        question = data[12:end]
+        # Выбираем свободный случайный ID, чтобы ответы разных клиентов не пересекались
+        while True:
+            txid = random.getrandbits(16).to_bytes(2, 'big')
+            key = (txid, question)
+            if key not in self.pending:
+                break
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        now = loop.time()
+        # Запрос без ответа дольше DNS_TIMEOUT считается потерянным
+        timer = loop.call_at(now + DNS_TIMEOUT, self.expire, key)
+        self.pending[key] = (future, data, now, timer)
+        self.stats.last_used = now
+        random.choice(self.transports).sendto(txid + data[2:])
+        return future
+
+    def expire(self, key):
+        waiter = self.pending.pop(key, None)
+        if waiter is None:
+            return
+        future = waiter[0]
+        self.stats.record_loss(asyncio.get_running_loop().time())
+        metrics.count('dns_upstream_timeouts_total', self.labels)
+        if not future.done():
+            future.set_result(None)
+
+    def datagram_received(self, response, addr):
+        end = question_end(response)
+        if end is None:
+            return
+        waiter = self.pending.pop((response[:2], response[12:end]), None)
+        if waiter is None:
+            return
+        future, data, sent, timer = waiter
+        timer.cancel()
+        now = asyncio.get_running_loop().time()
+        self.stats.record_reply(now - sent, len(response) > 3 and response[3] & 0x0F in (2, 5), now)
+        metrics.observe('dns_upstream_rtt_seconds', now - sent, self.labels)
+        if future.done():
+            return
+        # Ответ не поместился в UDP: повторяем запрос по TCP
+        if len(response) > 2 and response[2] & 0x02:
+            metrics.count('dns_upstream_tcp_queries_total', self.labels)
+            task = asyncio.ensure_future(self.tcp.query(data))
+            self.tasks.add(task)
+            task.add_done_callback(lambda task: self.tcp_done(task, future))
+            return
+        # Возвращаем клиенту его собственный ID
+        response = data[:2] + response[2:]
+        future.set_result(response if check_response(response, data, self.server) else None)
+
+    def tcp_done(self, task, future):
+        self.tasks.discard(task)
+        if not future.done():
+            future.set_result(None if task.cancelled() else task.result())
+
+# Каналы к DNS-серверам и цикл событий, в котором они работают
+channels = {}
+upstream_loop = None
+
+# Открытие каналов ко всем DNS-серверам в текущем цикле событий
+async def open_channels(servers):
+    global upstream_loop
+    upstream_loop = asyncio.get_running_loop()
+    for server in servers:
+        channel = (UpstreamStream if '://' in server else UpstreamChannel)(server)
+        try:
+            await channel.open(UPSTREAM_SOCKETS)
+        except OSError as e:
+            print(f"Ошибка сокета от {server}: {e}")
+        channels[server] = channel
+
+# Запуск отдельного потока с циклом событий для каналов (режим пула потоков)
+def start_upstream_loop(servers):
+    loop = asyncio.new_event_loop()
+    Thread(target=loop.run_forever, daemon=True).start()
+    asyncio.run_coroutine_threadsafe(open_channels(servers), loop).result()
+
+# Каналы в порядке предпочтения: сначала доступные с лучшей оценкой, затем недоступные
+def rank_channels(servers):
+    ranked = [channel for channel in map(channels.get, servers) if channel and channel.transports]
+    ranked.sort(key=lambda channel: (not channel.stats.healthy, channel.stats.score()))
+    return ranked
+
+# Ожидание первого корректного ответа среди отправленных запросов до момента until
+async def wait_reply(attempts, until):
+    loop = asyncio.get_running_loop()
+    while attempts:
+        done, _ = await asyncio.wait(attempts, timeout=until - loop.time(),
+                                     return_when=asyncio.FIRST_COMPLETED)
+        if not done:
+            break
+        for attempt in done:
+            attempts.discard(attempt)
+            if attempt.result():
+                return attempt
     return None
 
+# Запрос к DNS-серверам: сначала к лучшему, следующему - только если ответ
+# не пришёл за перцентиль RTT сервера или сервер вернул ошибку.
+# Возвращает (ответ, ответивший сервер) или (None, None)
+async def resolve_with_servers_async(data, servers):
+    loop = asyncio.get_running_loop()
+    now = loop.time()
+    deadline = now + DNS_TIMEOUT
+    ranked = rank_channels(servers)
+
+    # Пробные запросы возвращают недоступные серверы в работу; их ответы только обновляют статистику
+    for channel in ranked:
+        if channel.stats.probe_due(now) and channel is not ranked[0]:
+            channel.send(data)
+
+    attempts = set()
+    senders = {}
+    winner = None
+    for channel in ranked:
+        if len(attempts) > HEDGE_MAX or loop.time() >= deadline:
+            break
+        attempt = channel.send(data)
+        if attempt is None:
+            continue
+        attempts.add(attempt)
+        senders[attempt] = channel.server
+        winner = await wait_reply(attempts, min(loop.time() + channel.stats.hedge_delay, deadline))
+        if winner:
+            break
+    if not winner and attempts:
+        winner = await wait_reply(attempts, deadline)
+
+    if winner:
+        return winner.result(), senders[winner]
+    # Ни один сервер не дал корректного ответа
+    metrics.count('dns_upstream_failures_total')
+    return None, None
+
+# Состояние DNS-серверов для периодического отчёта
+def upstream_report():
+    lines = []
+    for server, channel in channels.items():
+        stats = channel.stats
+        lines.append(f"  {server}: RTT {stats.srtt * 1000:.1f} мс, потери {stats.loss:.1%}, "
+                     f"SERVFAIL {stats.servfail:.1%}{'' if stats.healthy else ', недоступен'}")
+    return '\n'.join(lines)
+
+# Снимок кэша на диске: заголовок, хеш-индекс с открытой адресацией и записи подряд.
+# Запись: время истечения и сохранения, QTYPE, QCLASS, бит DO, длины, имя,
+# смещения полей TTL и ответ в wire-формате. Файл отображается в память (mmap)
+# и читается лениво: запись переносится в кэш при первом обращении к ней,
+# поэтому запуск не зависит от количества записей в снимке.
+class CacheSnapshot:
+    MAGIC = b'LDNSSNAP'
+    VERSION = 1
+    HEADER = struct.Struct('!8sHIId')
+    INDEX_SLOT = struct.Struct('!II')
+    RECORD = struct.Struct('!ddHHBBBH')
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.memory = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count, self.slots, self.max_expires = self.HEADER.unpack_from(self.memory)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError(f"{path}: неизвестный формат снимка кэша")
+        self.records_start = self.HEADER.size + self.slots * self.INDEX_SLOT.size
+
+    @staticmethod
+    def key_hash(key):
+        qname, qtype, qclass, do_bit = key
+        return zlib.crc32(qname + struct.pack('!HHB', qtype, qclass, do_bit))
+
+    # Запись снимка по ключу, истекающая позже now: (истечение, сохранение, смещения TTL, ответ)
+    def lookup(self, key, now):
+        key_hash = self.key_hash(key)
+        mask = self.slots - 1
+        slot = key_hash & mask
+        while True:
+            slot_hash, offset = self.INDEX_SLOT.unpack_from(self.memory, self.HEADER.size + slot * self.INDEX_SLOT.size)
+            if not offset:
+                return None
+            if slot_hash == key_hash:
+                record = self.read(offset)
+                if record[0] == key:
+                    return record[1:] if record[1] > now else None
+            slot = (slot + 1) & mask
+
+    # Чтение записи: (ключ, истечение, сохранение, смещения TTL, ответ)
+    def read(self, offset):
+        expires, stored, qtype, qclass, do_bit, name_length, fields, length = self.RECORD.unpack_from(self.memory, offset)
+        offset += self.RECORD.size
+        qname = self.memory[offset:offset + name_length]
+        offset += name_length
+        ttl_offsets = struct.unpack_from(f'!{fields}H', self.memory, offset)
+        offset += 2 * fields
+        response = self.memory[offset:offset + length]
+        return (qname, qtype, qclass, bool(do_bit)), expires, stored, ttl_offsets, response
+
+    # Все записи снимка, истекающие позже now
+    def records(self, now):
+        offset = self.records_start
+        for _ in range(self.count):
+            key, expires, stored, ttl_offsets, response = self.read(offset)
+            offset += self.RECORD.size + len(key[0]) + 2 * len(ttl_offsets) + len(response)
+            if expires > now:
+                yield key, response, stored, expires, ttl_offsets
+
+    # Сохранение записей (ключ, ответ, сохранение, истечение, смещения TTL) в новый снимок.
+    # Файл пишется рядом и атомарно заменяет старый
+    @classmethod
+    def write(cls, path, records):
+        body = bytearray()
+        index = []
+        max_expires = 0.0
+        for key, response, stored, expires, ttl_offsets in records:
+            qname, qtype, qclass, do_bit = key
+            if len(ttl_offsets) > 255:
+                continue
+            index.append((cls.key_hash(key), len(body)))
+            body += cls.RECORD.pack(expires, stored, qtype, qclass, do_bit, len(qname), len(ttl_offsets), len(response))
+            body += qname + struct.pack(f'!{len(ttl_offsets)}H', *ttl_offsets) + response
+            max_expires = max(max_expires, expires)
+        slots = 1
+        while slots < 2 * len(index):
+            slots *= 2
+        records_start = cls.HEADER.size + slots * cls.INDEX_SLOT.size
+        table = [None] * slots
+        for key_hash, offset in index:
+            slot = key_hash & (slots - 1)
+            while table[slot] is not None:
+                slot = (slot + 1) & (slots - 1)
+            table[slot] = (key_hash, records_start + offset)
+        temporary = path + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, len(index), slots, max_expires))
+            f.write(b''.join(cls.INDEX_SLOT.pack(*slot) if slot else b'\0' * cls.INDEX_SLOT.size for slot in table))
+            f.write(body)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+        return len(index)
+
+# Запись кэша: ответ в wire-формате, время сохранения и истечения, смещения полей TTL
+class CacheEntry:
+    __slots__ = ('response', 'stored', 'expires', 'prefetch_at', 'refreshed', 'ttl_offsets', 'size', 'hits', 'aged')
+
+    def __init__(self, response, stored, expires, ttl_offsets, size):
+        self.response = response
+        self.stored = stored
+        self.expires = expires
+        # Момент, после которого популярную запись стоит обновить заранее
+        self.prefetch_at = stored + (expires - stored) * PREFETCH_THRESHOLD
+        # Когда последний раз запускалось фоновое обновление
+        self.refreshed = 0.0
+        self.ttl_offsets = ttl_offsets
+        self.size = size
+        self.hits = 1
+        # (прошедшие секунды, ответ с уменьшенными TTL): TTL пересчитываются не чаще раза в секунду;
+        # -1 - устаревший ответ с TTL = STALE_TTL
+        self.aged = (0, response)
+
+    # Ответ с TTL, уменьшенными на время, прошедшее с сохранения
+    def response_at(self, now):
+        elapsed = int(now - self.stored) if now < self.expires else -1
+        aged = self.aged
+        if aged[0] != elapsed:
+            if elapsed < 0:
+                response = stale_response(self.response, self.ttl_offsets)
+            else:
+                response = age_response(self.response, self.ttl_offsets, elapsed)
+            aged = self.aged = (elapsed, response)
+        return aged[1]
+
+# Кэш DNS-ответов с учётом TTL записей и ограничением по количеству и объёму
+class DNSCache:
+    # Примерные накладные расходы на запись (объект записи, ключ, слоты словарей)
+    ENTRY_OVERHEAD = 360
+
+    def __init__(self, max_entries=MAX_CACHE_SIZE, max_bytes=MAX_CACHE_BYTES, policy=CACHE_POLICY):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.entries = OrderedDict()
+        # Для LFU: количество обращений -> ключи в порядке добавления
+        self.frequencies = {}
+        self.min_frequency = 0
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale = 0
+        self.refreshes = 0
+        self.lock = Lock()
+        # Колесо таймеров: секунда, после которой запись уже нельзя отдавать как устаревшую -> ключи.
+        # Очистка проходит секунды по порядку и трогает только истёкшие записи
+        self.wheel = {}
+        self.wheel_position = int(time.time())
+        # Снимок с диска, записи которого ещё не перенесены в кэш
+        self.snapshot = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Секунда колеса таймеров, в которой запись удаляется
+    @staticmethod
+    def expiry_slot(entry):
+        return int(entry.expires + STALE_MAX_AGE) + 1
+
+    # Ответ из кэша с ID и регистром вопроса из запроса и уменьшенными TTL.
+    # Популярные записи под конец TTL и устаревшие записи обновляются в фоне
+    def get(self, key, data):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None and self.snapshot:
+                entry = self.restore(key, now)
+            if entry is None or entry.expires + STALE_MAX_AGE <= now:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.touch(key, entry)
+        if now >= entry.expires:
+            # RFC 8767: отвечаем устаревшими данными, пока запись обновляется
+            self.stale += 1
+            self.refresh(key, data, entry, now)
+        elif now >= entry.prefetch_at and entry.hits >= PREFETCH_MIN_HITS:
+            self.refresh(key, data, entry, now)
+        return serve_cached(entry.response_at(now), data, key[0])
+
+    # Перенос записи из снимка в кэш при первом обращении к ней
+    def restore(self, key, now):
+        if now - STALE_MAX_AGE >= self.snapshot.max_expires:
+            self.snapshot = None
+            return None
+        record = self.snapshot.lookup(key, now - STALE_MAX_AGE)
+        if record is None:
+            return None
+        expires, stored, ttl_offsets, response = record
+        entry = CacheEntry(response, stored, expires, ttl_offsets,
+                           sys.getsizeof(response) + sys.getsizeof(key[0]) + self.ENTRY_OVERHEAD)
+        self.insert(key, entry)
+        return entry
+
+    def refresh(self, key, data, entry, now):
+        if now - entry.refreshed >= REFRESH_RETRY_INTERVAL:
+            entry.refreshed = now
+            self.refreshes += 1
+            schedule_refresh(key, data)
+
+    # Сохранение ответа на срок минимального TTL его записей
+    def put(self, key, response):
+        ttl_offsets, min_ttl = parse_ttls(response)
+        if not min_ttl:
+            return
+        now = time.time()
+        ttl = min(min_ttl, CACHE_TTL)
+        response = cap_ttls(normalize_response(response, key[0]), ttl_offsets, ttl)
+        size = sys.getsizeof(response) + sys.getsizeof(key[0]) + self.ENTRY_OVERHEAD
+        entry = CacheEntry(response, now, now + ttl, ttl_offsets, size)
+        with self.lock:
+            self.insert(key, entry)
+
+    def insert(self, key, entry):
+        if key in self.entries:
+            self.remove(key)
+        # Освобождаем место до добавления, чтобы новая запись не вытеснила сама себя
+        while self.entries and (len(self.entries) >= self.max_entries or self.bytes + entry.size > self.max_bytes):
+            self.remove(self.victim())
+            self.evictions += 1
+        self.entries[key] = entry
+        self.bytes += entry.size
+        self.wheel.setdefault(self.expiry_slot(entry), set()).add(key)
+        if self.policy == 'lfu':
+            self.frequencies.setdefault(1, OrderedDict())[key] = None
+            self.min_frequency = 1
+
+    # Отметка обращения к записи
+    def touch(self, key, entry):
+        if self.policy == 'lfu':
+            bucket = self.frequencies[entry.hits]
+            del bucket[key]
+            if not bucket:
+                del self.frequencies[entry.hits]
+                if self.min_frequency == entry.hits:
+                    self.min_frequency += 1
+            entry.hits += 1
+            self.frequencies.setdefault(entry.hits, OrderedDict())[key] = None
+        else:
+            entry.hits += 1
+            self.entries.move_to_end(key)
+
+    # Ключ записи, которую следует вытеснить первой
+    def victim(self):
+        if self.policy == 'lfu':
+            if self.min_frequency not in self.frequencies:
+                self.min_frequency = min(self.frequencies)
+            return next(iter(self.frequencies[self.min_frequency]))
+        return next(iter(self.entries))
+
+    def remove(self, key):
+        entry = self.entries.pop(key)
+        self.bytes -= entry.size
+        slot = self.expiry_slot(entry)
+        keys = self.wheel.get(slot)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.wheel[slot]
+        if self.policy == 'lfu':
+            bucket = self.frequencies[entry.hits]
+            del bucket[key]
+            if not bucket:
+                del self.frequencies[entry.hits]
+
+    # Удаление не больше limit записей из секунд колеса, которые уже прошли
+    def expire(self, now, limit):
+        removed = 0
+        while self.wheel_position <= now and removed < limit:
+            keys = self.wheel.get(self.wheel_position)
+            while keys and removed < limit:
+                self.remove(keys.pop())
+                removed += 1
+            if self.wheel_position not in self.wheel:
+                self.wheel_position += 1
+        return removed
+
+    # Удаление записей, которые истекли и уже не могут отдаваться как устаревшие.
+    # Записи удаляются пачками, между которыми блокировка отпускается для обслуживающих потоков
+    def cleanup(self):
+        removed = 0
+        while True:
+            with self.lock:
+                expired = self.expire(time.time(), CACHE_EXPIRE_BATCH)
+            removed += expired
+            if expired < CACHE_EXPIRE_BATCH:
+                return removed
+            time.sleep(0)
+
+    # Записи для снимка: (ключ, ответ, сохранение, истечение, смещения TTL)
+    def records(self):
+        with self.lock:
+            entries = list(self.entries.items())
+        for key, entry in entries:
+            yield key, entry.response, entry.stored, entry.expires, entry.ttl_offsets
+
+    # Статистика кэша, включая занимаемую память
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'stale': self.stale,
+            'refreshes': self.refreshes,
+        }
+
+# Кэш в разделяемой памяти для нескольких рабочих процессов: хеш-таблица
+# с корзинами фиксированных ячеек в анонимном mmap, который наследуется при fork.
+# Ячейка: состояние, CRC32 тела, затем тело - хеш ключа, время истечения
+# и сохранения, длины, ключ, смещения полей TTL и ответ в wire-формате.
+# Читатели не берут блокировок: запись, изменённая во время чтения, не пройдёт проверку CRC.
+class SharedCache:
+    # Длина ключа - имя до 255 байт плюс тип, класс и бит DO - не помещается в байт
+    HEADER = struct.Struct('!BIIddHBH')
+    BODY_HEADER = struct.Struct('!IddHBH')
+    BODY_HEADER_SIZE = BODY_HEADER.size
+    LOCKS = 64
+
+    def __init__(self, max_entries=MAX_CACHE_SIZE, max_bytes=MAX_CACHE_BYTES,
+                 slot_size=SHARED_CACHE_SLOT_SIZE, ways=SHARED_CACHE_WAYS):
+        self.slot_size = slot_size
+        self.ways = ways
+        self.buckets = max(min(max_entries, max_bytes // slot_size) // ways, 1)
+        self.memory = mmap.mmap(-1, self.buckets * ways * slot_size)
+        self.locks = [multiprocessing.Lock() for _ in range(self.LOCKS)]
+        # Занятые ячейки по блокировкам корзин: счётчик меняется только под своей блокировкой,
+        # поэтому размер кэша для метрик считается без обхода всей памяти. Истёкшие ячейки
+        # учитываются, пока их не освободит очистка
+        self.counts = multiprocessing.Array('q', self.LOCKS, lock=False)
+        # Счётчики и время фоновых обновлений ведутся отдельно в каждом процессе
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale = 0
+        self.refreshes = 0
+        self.refreshed = {}
+        # Следующая корзина, которую проверит очистка
+        self.sweep_position = 0
+        # Снимок с диска, записи которого ещё не перенесены в кэш
+        self.snapshot = None
+
+    def __len__(self):
+        return sum(self.counts)
+
+    @staticmethod
+    def key_bytes(key):
+        qname, qtype, qclass, do_bit = key
+        return qname + struct.pack('!HHB', qtype, qclass, do_bit)
+
+    # Поиск ячейки с ключом, истекающей позже now; возвращает (смещение, тело ячейки) или (None, None)
+    def lookup(self, bucket, key_hash, key_bytes, now):
+        for way in range(self.ways):
+            offset = (bucket * self.ways + way) * self.slot_size
+            state, crc, slot_hash, expires, _, key_length, fields, length = self.HEADER.unpack_from(self.memory, offset)
+            if state != 1 or slot_hash != key_hash or expires <= now:
+                continue
+            body_size = self.BODY_HEADER_SIZE + key_length + 2 * fields + length
+            if 5 + body_size > self.slot_size:
+                continue
+            body = self.memory[offset + 5:offset + 5 + body_size]
+            if zlib.crc32(body) != crc:
+                continue
+            if body[self.BODY_HEADER_SIZE:self.BODY_HEADER_SIZE + key_length] == key_bytes:
+                return offset, body
+        return None, None
+
+    def get(self, key, data):
+        now = time.time()
+        key_bytes = self.key_bytes(key)
+        key_hash = zlib.crc32(key_bytes)
+        _, body = self.lookup(key_hash % self.buckets, key_hash, key_bytes, now - STALE_MAX_AGE)
+        if body is not None:
+            _, expires, stored, key_length, fields, _ = self.BODY_HEADER.unpack_from(body)
+            start = self.BODY_HEADER_SIZE + key_length
+            ttl_offsets = struct.unpack_from(f'!{fields}H', body, start)
+            response = body[start + 2 * fields:]
+        else:
+            record = self.restore(key, now)
+            if record is None:
+                self.misses += 1
+                return None
+            expires, stored, ttl_offsets, response = record
+        self.hits += 1
+        if now >= expires:
+            # RFC 8767: отвечаем устаревшими данными, пока запись обновляется
+            self.stale += 1
+            self.refresh(key, data, now)
+            return serve_cached(stale_response(response, ttl_offsets), data, key[0])
+        # Обращения к ячейкам не считаются, поэтому заранее обновляется любая запись,
+        # которую запрашивают под конец её TTL
+        if now >= stored + (expires - stored) * PREFETCH_THRESHOLD:
+            self.refresh(key, data, now)
+        return serve_cached(age_response(response, ttl_offsets, int(now - stored)), data, key[0])
+
+    # Перенос записи из снимка в общую память при первом обращении к ней
+    def restore(self, key, now):
+        if not self.snapshot:
+            return None
+        if now - STALE_MAX_AGE >= self.snapshot.max_expires:
+            self.snapshot = None
+            return None
+        record = self.snapshot.lookup(key, now - STALE_MAX_AGE)
+        if record is not None:
+            expires, stored, ttl_offsets, response = record
+            self.store(key, response, stored, expires, ttl_offsets)
+        return record
+
+    def refresh(self, key, data, now):
+        if now - self.refreshed.get(key, 0.0) >= REFRESH_RETRY_INTERVAL:
+            self.refreshed[key] = now
+            self.refreshes += 1
+            schedule_refresh(key, data)
+
+    def put(self, key, response):
+        ttl_offsets, min_ttl = parse_ttls(response)
+        if not min_ttl or len(ttl_offsets) > 255:
+            return
+        now = time.time()
+        ttl = min(min_ttl, CACHE_TTL)
+        self.store(key, cap_ttls(normalize_response(response, key[0]), ttl_offsets, ttl), now, now + ttl, ttl_offsets)
+
+    def store(self, key, response, stored, expires, ttl_offsets):
+        key_bytes = self.key_bytes(key)
+        key_hash = zlib.crc32(key_bytes)
+        body = (self.BODY_HEADER.pack(key_hash, expires, stored,
+                                      len(key_bytes), len(ttl_offsets), len(response))
+                + key_bytes + struct.pack(f'!{len(ttl_offsets)}H', *ttl_offsets) + response)
+        if 5 + len(body) > self.slot_size:
+            return
+        bucket = key_hash % self.buckets
+        with self.locks[bucket % self.LOCKS]:
+            offset, _ = self.lookup(bucket, key_hash, key_bytes, 0)
+            if offset is None:
+                offset = self.victim(bucket, time.time())
+            if self.memory[offset] != 1:
+                self.counts[bucket % self.LOCKS] += 1
+            # Сначала помечаем ячейку пустой, чтобы читатели не увидели её наполовину записанной
+            self.memory[offset] = 0
+            self.memory[offset + 5:offset + 5 + len(body)] = body
+            struct.pack_into('!BI', self.memory, offset, 1, zlib.crc32(body))
+
+    # Ячейка для новой записи: пустая, истёкшая или та, что истекает раньше остальных
+    def victim(self, bucket, now):
+        victim, victim_expires = None, None
+        for way in range(self.ways):
+            offset = (bucket * self.ways + way) * self.slot_size
+            state, _, _, expires = struct.unpack_from('!BIId', self.memory, offset)
+            if state != 1 or expires <= now:
+                return offset
+            if victim is None or expires < victim_expires:
+                victim, victim_expires = offset, expires
+        self.evictions += 1
+        return victim
+
+    # Освобождение ячеек, которые истекли и уже не могут отдаваться как устаревшие.
+    # Истёкшие ячейки и так занимаются новыми записями, поэтому за один вызов
+    # проверяется не больше CACHE_EXPIRE_BATCH корзин, а весь кэш - за несколько вызовов
+    def cleanup(self):
+        now = time.time()
+        start = self.sweep_position
+        end = min(start + CACHE_EXPIRE_BATCH, self.buckets)
+        self.sweep_position = end % self.buckets
+        if self.sweep_position == 0:
+            self.refreshed = {key: refreshed for key, refreshed in self.refreshed.items()
+                              if now - refreshed < REFRESH_RETRY_INTERVAL}
+        now -= STALE_MAX_AGE
+        removed = 0
+        for bucket in range(start, end):
+            with self.locks[bucket % self.LOCKS]:
+                for way in range(self.ways):
+                    offset = (bucket * self.ways + way) * self.slot_size
+                    state, _, _, expires = struct.unpack_from('!BIId', self.memory, offset)
+                    if state == 1 and expires <= now:
+                        self.memory[offset] = 0
+                        self.counts[bucket % self.LOCKS] -= 1
+                        removed += 1
+        return removed
+
+    # Записи для снимка: (ключ, ответ, сохранение, истечение, смещения TTL)
+    def records(self):
+        for offset in range(0, len(self.memory), self.slot_size):
+            state, crc, _, _, _, key_length, fields, length = self.HEADER.unpack_from(self.memory, offset)
+            body_size = self.BODY_HEADER_SIZE + key_length + 2 * fields + length
+            if state != 1 or 5 + body_size > self.slot_size:
+                continue
+            body = self.memory[offset + 5:offset + 5 + body_size]
+            if zlib.crc32(body) != crc:
+                continue
+            _, expires, stored, _, _, _ = self.BODY_HEADER.unpack_from(body)
+            key_bytes = body[self.BODY_HEADER_SIZE:self.BODY_HEADER_SIZE + key_length]
+            qtype, qclass, do_bit = struct.unpack('!HHB', key_bytes[-5:])
+            start = self.BODY_HEADER_SIZE + key_length
+            ttl_offsets = struct.unpack_from(f'!{fields}H', body, start)
+            yield (key_bytes[:-5], qtype, qclass, bool(do_bit)), body[start + 2 * fields:], stored, expires, ttl_offsets
+
+    def stats(self):
+        entries = len(self)
+        return {
+            'entries': entries,
+            'bytes': entries * self.slot_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'stale': self.stale,
+            'refreshes': self.refreshes,
+        }
+
+# Кэш запросов
+cache = DNSCache()
+
+# Запросы к DNS-серверам, которые ещё ждут ответа: ключ кэша -> future
+inflight = {}
+# Сколько промахов кэша ушло к DNS-серверам и сколько присоединилось к уже идущему запросу
+resolver_stats = {'upstream': 0, 'coalesced': 0}
+
+# Ответ с ID и регистром вопроса из запроса клиента
+def reply_for(response, data, key):
+    end = 12 + len(key[0])
+    return data[:2] + response[2:12] + data[12:end] + response[end:]
+
+# Запрос к DNS-серверам с сохранением ответа в кэш
+async def resolve_and_cache(data, key):
+    response, server = await resolve_with_servers_async(data, DNS_SERVERS)
+    if response:
+        cache.put(key, response)
+    return response, server
+
+# Разрешение промаха кэша: одинаковые вопросы ждут один общий запрос к DNS-серверам.
+# Возвращает (ответ, ответивший сервер) или (None, None)
+async def resolve_async(data, key):
+    future = inflight.get(key)
+    if future is None:
+        resolver_stats['upstream'] += 1
+        future = asyncio.ensure_future(resolve_and_cache(data, key))
+        inflight[key] = future
+        future.add_done_callback(lambda _: inflight.pop(key, None))
+    else:
+        resolver_stats['coalesced'] += 1
+    # shield: отмена одного ожидающего не должна отменять общий запрос
+    response, server = await asyncio.shield(future)
+    if response:
+        return reply_for(response, data, key), server
+    return None, None
+
+# Фоновое обновление записи кэша: упреждающее или для устаревшей записи.
+# Идёт через resolve_async, поэтому совпадает с уже идущим запросом, если он есть
+def schedule_refresh(key, data):
+    if upstream_loop is not None:
+        asyncio.run_coroutine_threadsafe(resolve_async(data, key), upstream_loop)
+
+# Разрешение промаха кэша из рабочего потока
+def resolve(data, key):
+    return asyncio.run_coroutine_threadsafe(resolve_async(data, key), upstream_loop).result()
+
+# Доступ клиентов: списки сетей IPv4 и IPv6 и ограничение скорости.
+# Сети хранятся по длинам префиксов: {семейство: {длина: {сеть: разрешена}}}, и поиск идёт
+# от самого длинного префикса к короткому - решает самое точное правило
+class AccessControl:
+    def __init__(self, allow=ALLOW_NETWORKS, deny=DENY_NETWORKS):
+        self.default = allow is None
+        self.prefixes = {socket.AF_INET: {}, socket.AF_INET6: {}}
+        # Запрет важнее разрешения той же сети, поэтому добавляется последним
+        for networks, allowed in ((allow or [], True), (deny, False)):
+            for network in networks:
+                network = ip_network(network, strict=False)
+                family = socket.AF_INET if network.version == 4 else socket.AF_INET6
+                prefixes = self.prefixes[family].setdefault(network.prefixlen, {})
+                prefixes[int(network.network_address) >> (network.max_prefixlen - network.prefixlen)] = allowed
+        self.lengths = {family: sorted(prefixes, reverse=True) for family, prefixes in self.prefixes.items()}
+        self.rules = allow is not None or bool(deny)
+        self.enabled = self.rules or CLIENT_RATE > 0
+        # Решения по адресам клиентов, token bucket клиентов и счётчики одинаковых ответов (RRL)
+        self.decisions = {}
+        self.buckets = {}
+        self.responses = {}
+
+    # Пропустить ли запрос клиента: проверка сетей и token bucket (CLIENT_RATE, CLIENT_BURST)
+    def admit(self, client_address):
+        host = client_address[0]
+        if self.rules:
+            allowed = self.decisions.get(host)
+            if allowed is None:
+                allowed = self.lookup(host)
+                self.bound(self.decisions)
+                self.decisions[host] = allowed
+            if not allowed:
+                metrics.count('dns_dropped_total', 'reason="acl"')
+                return False
+        if CLIENT_RATE and not self.take_token(host, time.monotonic()):
+            metrics.count('dns_dropped_total', 'reason="rate"')
+            return False
+        return True
+
+    def lookup(self, host):
+        family, bits = (socket.AF_INET6, 128) if ':' in host else (socket.AF_INET, 32)
+        try:
+            address = int.from_bytes(socket.inet_pton(family, host), 'big')
+        except OSError:
+            return False
+        prefixes = self.prefixes[family]
+        for length in self.lengths[family]:
+            allowed = prefixes[length].get(address >> (bits - length))
+            if allowed is not None:
+                return allowed
+        return self.default
+
+    def take_token(self, host, now):
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            self.bound(self.buckets)
+            self.buckets[host] = [CLIENT_BURST - 1, now]
+            return True
+        tokens = min(CLIENT_BURST, bucket[0] + (now - bucket[1]) * CLIENT_RATE)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return False
+        bucket[0] = tokens - 1
+        return True
+
+    # Ограничение одинаковых ответов (имя, тип, код ответа) одной сети клиентов: не даёт использовать
+    # сервер для отражённых атак с подменой адреса. Ответ, TC-ответ (каждый RRL_SLIP-й подавленный) или None
+    def limit_response(self, response, data, key, client_address):
+        host = client_address[0]
+        if ':' in host:
+            try:
+                network = socket.inet_pton(socket.AF_INET6, host)[:7]
+            except OSError:
+                network = host
+        else:
+            network = host.rpartition('.')[0]
+        token = (network, key[0], key[1], response[3] & 0x0F)
+        second = int(time.monotonic())
+        state = self.responses.get(token)
+        if state is None or state[0] != second:
+            if state is None:
+                self.bound(self.responses)
+            self.responses[token] = [second, 1]
+            return response
+        state[1] += 1
+        if state[1] <= RRL_RATE:
+            return response
+        metrics.count('dns_rrl_limited_total')
+        if RRL_SLIP and state[1] % RRL_SLIP == 0:
+            return truncated_response(response, edns_payload_size(data))
+        return None
+
+    # Таблицы ограничены RATE_LIMIT_CLIENTS записями: при переполнении удаляется четверть самых старых
+    @staticmethod
+    def bound(table):
+        if len(table) >= RATE_LIMIT_CLIENTS:
+            for key in list(islice(table, len(table) // 4 + 1)):
+                table.pop(key, None)
+
+access = AccessControl()
+
+# Локальная политика: блок-листы и переопределения адресов из скомпилированного файла.
+# Файл: заголовок, хеш-индекс с открытой адресацией и записи (длина имени, имя в wire-формате,
+# флаги, затем IPv4 и IPv6, если они заданы). Файл отображается в память, поэтому запуск и память не зависят от размера списков.
+# Правило '*.example.com' хранится под именем с меткой '*' и действует на все поддомены example.com.
+# В заголовке - маска числа меток доменов с такими правилами, чтобы не искать лишние родительские домены
+class PolicyZone:
+    MAGIC = b'LDNSPLCY'
+    VERSION = 1
+    HEADER = struct.Struct('!8sHII16s')
+    INDEX_SLOT = struct.Struct('!II')
+    INDEX_START = HEADER.size
+    BLOCK, IPV4, IPV6 = 1, 2, 4
+    # Имена из стандартного файла hosts, которые не являются правилами блокировки
+    HOSTS_NAMES = {'localhost', 'localhost.localdomain', 'local', 'broadcasthost', 'ip6-localhost', 'ip6-loopback'}
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.memory = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.slots, self.count, wildcards = self.HEADER.unpack_from(self.memory)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError(f"{path}: неизвестный формат файла политики")
+        self.wildcards = int.from_bytes(wildcards, 'big')
+        self.mask = self.slots - 1
+        self.read_slot = self.INDEX_SLOT.unpack_from
+
+    # Правило для имени в wire-формате: (флаги, IPv4, IPv6) или None
+    def lookup(self, name):
+        memory = self.memory
+        name_hash = zlib.crc32(name)
+        mask = self.mask
+        slot = name_hash & mask
+        while True:
+            slot_hash, offset = self.read_slot(memory, self.INDEX_START + 8 * slot)
+            if not offset:
+                return None
+            if slot_hash == name_hash and memory[offset + 1:offset + 1 + memory[offset]] == name:
+                offset += 1 + len(name)
+                flags = self.memory[offset]
+                ipv4 = self.memory[offset + 1:offset + 5] if flags & self.IPV4 else None
+                offset += 5 if flags & self.IPV4 else 1
+                ipv6 = self.memory[offset:offset + 16] if flags & self.IPV6 else None
+                return flags, ipv4, ipv6
+            slot = (slot + 1) & mask
+
+    # Точное правило для имени, иначе правило '*' ближайшего родительского домена: O(число меток)
+    def match(self, qname):
+        rule = self.lookup(qname)
+        if rule is not None or not self.wildcards:
+            return rule
+        starts = []
+        i = 0
+        while qname[i]:
+            starts.append(i)
+            i += qname[i] + 1
+        for depth in range(len(starts) - 1, 0, -1):
+            if self.wildcards >> depth & 1:
+                rule = self.lookup(b'\x01*' + qname[starts[-depth]:])
+                if rule is not None:
+                    return rule
+        return None
+
+    # Ответ политики на запрос или None, если имя не упомянуто в списках
+    def answer(self, data, key):
+        rule = self.match(key[0])
+        if rule is None:
+            return None
+        flags, ipv4, ipv6 = rule
+        qtype = key[1]
+        rcode = 0
+        rdata = None
+        if flags & (self.IPV4 | self.IPV6):
+            # Переопределение: на A и AAAA отвечаем заданным адресом, на остальные типы - NODATA
+            if qtype == 1 and flags & self.IPV4:
+                rdata = ipv4
+            elif qtype == 28 and flags & self.IPV6:
+                rdata = ipv6
+        elif POLICY_BLOCK_MODE == 'zero':
+            rdata = bytes(4) if qtype == 1 else bytes(16) if qtype == 28 else None
+        else:
+            rcode = 3
+        # QR и RA, RD копируется из запроса
+        header = data[:2] + bytes((0x80 | data[2] & 0x01, 0x80 | rcode)) + struct.pack('!4H', 1, 1 if rdata else 0, 0, 0)
+        answer = b'\xc0\x0c' + RECORD_FIELDS.pack(qtype, 1, POLICY_TTL, len(rdata)) + rdata if rdata else b''
+        return header + data[12:12 + len(key[0]) + 4] + answer
+
+    # Компиляция списков в файл политики. Строки: 'example.com' или '*.example.com' - блокировка;
+    # формат hosts 'адрес имя...' - переопределение, адреса 0.0.0.0, 127.0.0.1, :: и ::1 - блокировка.
+    # Файл пишется рядом и атомарно заменяет старый, так что работающий сервер подхватит его целиком
+    @classmethod
+    def compile(cls, path, sources):
+        rules = {}
+        for source in sources:
+            with open(source, encoding='utf-8', errors='replace') as f:
+                for line in f:
+                    fields = line.split('#', 1)[0].split()
+                    if not fields:
+                        continue
+                    # Первое поле - адрес в формате hosts, иначе вся строка состоит из имён
+                    flags, address, names = cls.BLOCK, b'', fields
+                    if len(fields) > 1 and fields[0] not in ('0.0.0.0', '127.0.0.1', '::', '::1'):
+                        family = socket.AF_INET6 if ':' in fields[0] else socket.AF_INET
+                        try:
+                            address = socket.inet_pton(family, fields[0])
+                            flags = cls.IPV6 if family == socket.AF_INET6 else cls.IPV4
+                        except OSError:
+                            pass
+                    if len(fields) > 1 and (address or fields[0] in ('0.0.0.0', '127.0.0.1', '::', '::1')):
+                        names = fields[1:]
+                    for name in names:
+                        if name.lower() in cls.HOSTS_NAMES:
+                            continue
+                        wire = cls.wire_name(name)
+                        if wire is None:
+                            continue
+                        rule = rules.setdefault(wire, [0, b'', b''])
+                        rule[0] |= flags
+                        if flags == cls.IPV4:
+                            rule[1] = address
+                        elif flags == cls.IPV6:
+                            rule[2] = address
+        slots = 1
+        while slots < 2 * len(rules):
+            slots *= 2
+        records_start = cls.INDEX_START + slots * cls.INDEX_SLOT.size
+        table = [None] * slots
+        body = bytearray()
+        wildcards = 0
+        for name, (flags, ipv4, ipv6) in rules.items():
+            # Число меток домена, к поддоменам которого относится правило '*'
+            if name.startswith(b'\x01*'):
+                depth = 0
+                i = 2
+                while name[i]:
+                    depth += 1
+                    i += name[i] + 1
+                wildcards |= 1 << depth
+            name_hash = zlib.crc32(name)
+            slot = name_hash & (slots - 1)
+            while table[slot] is not None:
+                slot = (slot + 1) & (slots - 1)
+            table[slot] = (name_hash, records_start + len(body))
+            body += bytes((len(name),)) + name + bytes((flags,)) + ipv4 + ipv6
+        temporary = path + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, slots, len(rules), wildcards.to_bytes(16, 'big')))
+            f.write(b''.join(cls.INDEX_SLOT.pack(*slot) if slot else b'\0' * cls.INDEX_SLOT.size for slot in table))
+            f.write(body)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+        return len(rules)
+
+    # Имя в wire-формате в нижнем регистре или None для некорректного имени
+    @staticmethod
+    def wire_name(name):
+        name = name.strip('.').lower()
+        try:
+            encoded = name.encode('ascii').split(b'.')
+        except UnicodeError:
+            try:
+                encoded = [label.encode('idna') if label != '*' else b'*' for label in name.split('.')]
+            except UnicodeError:
+                return None
+        if not all(0 < len(label) <= 63 for label in encoded) or b'*' in encoded[1:]:
+            return None
+        wire = b''.join(bytes((len(label),)) + label for label in encoded) + b'\0'
+        return wire if len(wire) <= 255 else None
+
+# Текущая политика; при обновлении файла заменяется целиком новым объектом или None,
+# поэтому обработчики запросов читают её в локальную переменную один раз
+policy = None
+
 # Обработка входящего DNS-запроса
 def handle_request(data, client_address):
-    domain, request_id = extract_domain(data)
+    start = mark = time.perf_counter()
+    key = parse_query(data)
 
-    if not domain or not request_id:
+    if not key:
         server_socket.sendto(ERROR_RESPONSE, client_address)
+        finish_request(start, mark, 'transport="udp",result="error"', client_address)
         return
+    if STAGE_TIMING:
+        mark = metrics.stage('parse', mark)
 
-    # Проверяем кэш
-    if domain in cache:
-        cached_response, timestamp = cache[domain]
-        if time.time() - timestamp < CACHE_TTL:
-            server_socket.sendto(request_id + cached_response[2:], client_address)
+    # Блок-листы и переопределения отвечают раньше кэша и DNS-серверов
+    zone = policy
+    if zone is not None:
+        response = zone.answer(data, key)
+        if response:
+            server_socket.sendto(response, client_address)
+            finish_request(start, mark, 'transport="udp",result="policy"', client_address, key, response)
             return
 
+    # Проверяем кэш
+    cached_response = cache.get(key, data)
+    if STAGE_TIMING:
+        mark = metrics.stage('cache', mark)
+    if cached_response:
+        if len(cached_response) > 512 or RRL_RATE:
+            cached_response = udp_response(cached_response, data, key, client_address)
+        if cached_response:
+            server_socket.sendto(cached_response, client_address)
+        finish_request(start, mark, 'transport="udp",result="hit"', client_address, key, cached_response)
+        return
+
     # Параллельный запрос к DNS-серверам
-    response = resolve_with_servers(data, DNS_SERVERS)
+    response, server = resolve(data, key)
+    if STAGE_TIMING:
+        mark = metrics.stage('upstream', mark)
     if response:
-        cache[domain] = (response, time.time())
-        server_socket.sendto(response, client_address)
+        response = udp_response(response, data, key, client_address)
+        if response:
+            server_socket.sendto(response, client_address)
+        finish_request(start, mark, 'transport="udp",result="miss"', client_address, key, response, server)
     else:
         # Если ни один сервер не ответил
         server_socket.sendto(ERROR_RESPONSE, client_address)
+        finish_request(start, mark, 'transport="udp",result="error"', client_address, key)
 
-# Очистка устаревших записей в кэше
+# Очистка устаревших записей в кэше и вывод статистики
 def cleanup_cache():
+    report_at = time.time() + CACHE_CLEANUP_INTERVAL
     while True:
-        time.sleep(CACHE_CLEANUP_INTERVAL)
+        time.sleep(CACHE_EXPIRE_INTERVAL)
+        cache.cleanup()
+        if time.time() < report_at:
+            continue
+        report_at += CACHE_CLEANUP_INTERVAL
+        stats = cache.stats()
+        print(f"Кэш: {stats['entries']} записей, {stats['bytes'] // 1024} КБ, "
+              f"попаданий {stats['hits']}, промахов {stats['misses']}, вытеснено {stats['evictions']}, "
+              f"устаревших ответов {stats['stale']}, фоновых обновлений {stats['refreshes']}")
+        print(f"Запросов к DNS-серверам: {resolver_stats['upstream']}, "
+              f"объединено с уже идущими: {resolver_stats['coalesced']}")
+        print(upstream_report())
+
+# Метрики для /metrics: накопленные счётчики и гистограммы, а также состояние кэша и DNS-серверов
+def metrics_text():
+    stats = cache.stats()
+    gauges = {('dns_cache_entries', ''): stats['entries'], ('dns_cache_bytes', ''): stats['bytes']}
+    totals = {(f'dns_cache_{name}_total', ''): stats[name] for name in ('hits', 'misses', 'evictions', 'stale', 'refreshes')}
+    totals[('dns_upstream_queries_total', '')] = resolver_stats['upstream']
+    totals[('dns_coalesced_queries_total', '')] = resolver_stats['coalesced']
+    if query_log is not None:
+        totals[('dns_query_log_records_total', '')] = query_log.written
+        totals[('dns_query_log_rotations_total', '')] = query_log.rotations
+    if capture is not None:
+        totals[('dns_capture_records_total', '')] = capture.written
+    for channel in list(channels.values()):
+        stats = channel.stats
+        gauges[('dns_upstream_srtt_seconds', channel.labels)] = stats.srtt
+        gauges[('dns_upstream_hedge_delay_seconds', channel.labels)] = stats.hedge_delay
+        gauges[('dns_upstream_loss_ratio', channel.labels)] = stats.loss
+        gauges[('dns_upstream_servfail_ratio', channel.labels)] = stats.servfail
+        gauges[('dns_upstream_healthy', channel.labels)] = int(stats.healthy)
+        gauges[('dns_upstream_tcp_connections', channel.labels)] = len(channel.tcp.connections)
+    return metrics.render(gauges, totals)
+
+# HTTP-обработчик метрик: GET /metrics
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics_text().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# Запуск HTTP-сервера метрик в отдельном потоке
+def start_metrics_server(port):
+    try:
+        server = HTTPServer((METRICS_ADDRESS, port), MetricsHandler)
+    except OSError as e:
+        print(f"Не удалось запустить сервер метрик на порту {port}: {e}")
+        return
+    Thread(target=server.serve_forever, daemon=True).start()
+
+# Загрузка файла политики, если он появился или был заменён с прошлой проверки
+policy_version = None
+
+def load_policy():
+    global policy, policy_version
+    try:
+        info = os.stat(POLICY_FILE)
+    except OSError:
+        if policy is not None:
+            print(f"Файл политики {POLICY_FILE} удалён, блок-листы отключены")
+        policy, policy_version = None, None
+        return
+    version = (info.st_ino, info.st_mtime_ns, info.st_size)
+    if version == policy_version:
+        return
+    try:
+        policy = PolicyZone(POLICY_FILE)
+        print(f"Политика {POLICY_FILE}: {policy.count} правил")
+    except (OSError, ValueError, struct.error) as e:
+        print(f"Не удалось загрузить политику {POLICY_FILE}: {e}")
+    policy_version = version
+
+# Периодическая проверка файла политики: новый файл подхватывается без перезапуска
+def watch_policy():
+    while True:
+        time.sleep(POLICY_RELOAD_INTERVAL)
+        load_policy()
+
+# Открытие снимка кэша, сохранённого при прошлой остановке
+def load_snapshot():
+    if not SNAPSHOT_FILE or not os.path.exists(SNAPSHOT_FILE):
+        return
+    try:
+        cache.snapshot = CacheSnapshot(SNAPSHOT_FILE)
+        print(f"Снимок кэша {SNAPSHOT_FILE}: {cache.snapshot.count} записей")
+    except (OSError, ValueError, struct.error) as e:
+        print(f"Не удалось открыть снимок кэша {SNAPSHOT_FILE}: {e}")
+
+snapshot_lock = Lock()
+
+# Сохранение кэша в снимок вместе с ещё не перенесёнными записями прошлого снимка
+def save_snapshot():
+    if not SNAPSHOT_FILE:
+        return
+    with snapshot_lock:
         now = time.time()
-        to_delete = [domain for domain, (_, timestamp) in cache.items() if now - timestamp > CACHE_TTL]
-        for domain in to_delete:
-            del cache[domain]
+        snapshot = cache.snapshot
+        saved = set()
+
+        def records():
+            for record in cache.records():
+                if record[3] + STALE_MAX_AGE > now:
+                    saved.add(record[0])
+                    yield record
+            if snapshot:
+                for record in snapshot.records(now - STALE_MAX_AGE):
+                    if record[0] not in saved:
+                        yield record
+
+        try:
+            count = CacheSnapshot.write(SNAPSHOT_FILE, records())
+            print(f"Кэш сохранён в {SNAPSHOT_FILE}: {count} записей")
+        except OSError as e:
+            print(f"Не удалось сохранить снимок кэша {SNAPSHOT_FILE}: {e}")
+
+# Периодическое сохранение снимка кэша
+def save_snapshots():
+    while True:
+        time.sleep(SNAPSHOT_INTERVAL)
+        save_snapshot()
+
+# Поступил сигнал остановки (SIGTERM или SIGINT)
+stop_requested = False
+
+# Обработчик сигнала остановки только поднимает флаг. Снимок и журналы сохраняет главный поток
+# уже вне обработки запросов: обработчик выполняется посреди любого кода главного потока
+# и ждал бы блокировку кэша, которую этот поток держит
+def request_stop(signum, frame):
+    global stop_requested
+    stop_requested = True
+
+def ignore_signal(signum, frame):
+    pass
+
+# Перехват сигналов: номер каждого пришедшего сигнала записывается в канал (signal.set_wakeup_fd),
+# чтение из которого будит главный поток. SIGTERM и SIGINT - сигналы остановки, остальные только будят.
+# Возвращает конец канала для чтения
+def catch_signals(*signums):
+    read_fd, write_fd = os.pipe()
+    os.set_blocking(write_fd, False)
+    signal.set_wakeup_fd(write_fd)
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, request_stop)
+    for signum in signums:
+        signal.signal(signum, ignore_signal)
+    return read_fd
+
+# Ожидание сигнала в главном потоке; возвращает номер сигнала
+def wait_signal(signal_fd):
+    return os.read(signal_fd, 1)[0]
+
+# Сохранение снимка (save), журнала и захвата запросов и выход. Потоки обработки запросов -
+# фоновые, поэтому процесс завершается сразу, не дожидаясь их
+def shutdown(save=True):
+    if save:
+        save_snapshot()
+    close_logs()
+    sys.stdout.flush()
+    os._exit(0)
+
+# Запись остатка журнала и захвата запросов на диск
+def close_logs():
+    for log in (query_log, capture):
+        if log is None:
+            continue
+        try:
+            log.close()
+        except OSError as e:
+            print(f"Не удалось записать {log.TITLE} {log.path}: {e}")
 
 # Основной цикл обработки запросов
 def listen_for_requests():
     with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
         while True:
             try:
-                data, client_address = server_socket.recvfrom(1024)
+                data, client_address = server_socket.recvfrom(65535)
+                # Отбрасываем запрос до передачи в пул потоков
+                if access.enabled and not access.admit(client_address):
+                    continue
+                if capture is not None:
+                    capture.add(data)
                 executor.submit(handle_request, data, client_address)
             except Exception as e:
                 print(f"Ошибка: {e}")
 
-if __name__ == "__main__":
-    # Увеличение лимита открытых файловых дескрипторов (для *nix систем)
+# Режим 'batch': поток вычитывает из сокета пачку пакетов в заранее выделенное кольцо буферов,
+# сам отвечает на попадания в кэш и отправляет ответы пачкой; промахи одной пачки передаются
+# в цикл событий каналов за одно пробуждение, и ответы на них отправляет уже этот цикл
+def listen_for_requests_batch():
+    buffers = [memoryview(bytearray(65535)) for _ in range(BATCH_SIZE)]
+    while True:
+        # Первый пакет ждём, остальные забираем, пока они есть в очереди сокета
+        packets = []
+        flags = 0
+        try:
+            for buffer in buffers:
+                size, client_address = server_socket.recvfrom_into(buffer, 0, flags)
+                packets.append((buffer[:size], client_address))
+                flags = socket.MSG_DONTWAIT
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            print(f"Ошибка: {e}")
+
+        replies = []
+        misses = []
+        for packet, client_address in packets:
+            if access.enabled and not access.admit(client_address):
+                continue
+            start = mark = time.perf_counter()
+            data = bytes(packet)
+            if capture is not None:
+                capture.add(data)
+            key = parse_query(data)
+            if not key:
+                replies.append((ERROR_RESPONSE, client_address, key, start, mark, 'transport="udp",result="error"'))
+                continue
+            if STAGE_TIMING:
+                mark = metrics.stage('parse', mark)
+            zone = policy
+            if zone is not None:
+                response = zone.answer(data, key)
+                if response:
+                    replies.append((response, client_address, key, start, mark, 'transport="udp",result="policy"'))
+                    continue
+            cached_response = cache.get(key, data)
+            if STAGE_TIMING:
+                mark = metrics.stage('cache', mark)
+            if cached_response:
+                if len(cached_response) > 512 or RRL_RATE:
+                    cached_response = udp_response(cached_response, data, key, client_address)
+                if cached_response:
+                    replies.append((cached_response, client_address, key, start, mark, 'transport="udp",result="hit"'))
+            else:
+                misses.append((data, key, client_address, start, mark))
+
+        if misses:
+            upstream_loop.call_soon_threadsafe(resolve_misses, misses)
+        for response, client_address, key, start, mark, labels in replies:
+            try:
+                server_socket.sendto(response, client_address)
+            except OSError as e:
+                print(f"Ошибка: {e}")
+            finish_request(start, mark, labels, client_address, key, response)
+
+# Задачи разрешения промахов режима 'batch'
+batch_tasks = set()
+
+# Запуск разрешения промахов пачки в цикле событий каналов
+def resolve_misses(misses):
+    for miss in misses:
+        task = asyncio.ensure_future(resolve_miss(*miss))
+        batch_tasks.add(task)
+        task.add_done_callback(batch_tasks.discard)
+
+async def resolve_miss(data, key, client_address, start, mark):
+    response, server = await resolve_async(data, key)
+    if STAGE_TIMING:
+        mark = metrics.stage('upstream', mark)
+    labels = 'transport="udp",result="miss"' if response else 'transport="udp",result="error"'
+    response = udp_response(response, data, key, client_address) if response else ERROR_RESPONSE
+    # Цикл событий не должен блокироваться на отправке: при переполненном буфере сокета ответ теряется
+    if response:
+        try:
+            server_socket.sendto(response, socket.MSG_DONTWAIT, client_address)
+        except OSError:
+            metrics.count('dns_send_dropped_total')
+    finish_request(start, mark, labels, client_address, key, response, server)
+
+# Обработка запросов в асинхронном режиме: один цикл событий вместо потока на запрос
+class DNSServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.transport = None
+        self.tasks = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, client_address):
+        if access.enabled and not access.admit(client_address):
+            return
+        if capture is not None:
+            capture.add(data)
+        start = mark = time.perf_counter()
+        key = parse_query(data)
+
+        if not key:
+            self.transport.sendto(ERROR_RESPONSE, client_address)
+            finish_request(start, mark, 'transport="udp",result="error"', client_address)
+            return
+        if STAGE_TIMING:
+            mark = metrics.stage('parse', mark)
+
+        zone = policy
+        if zone is not None:
+            response = zone.answer(data, key)
+            if response:
+                self.transport.sendto(response, client_address)
+                finish_request(start, mark, 'transport="udp",result="policy"', client_address, key, response)
+                return
+
+        # Попадание в кэш обслуживается сразу, без создания задачи
+        cached_response = cache.get(key, data)
+        if STAGE_TIMING:
+            mark = metrics.stage('cache', mark)
+        if cached_response:
+            if len(cached_response) > 512 or RRL_RATE:
+                cached_response = udp_response(cached_response, data, key, client_address)
+            if cached_response:
+                self.transport.sendto(cached_response, client_address)
+            finish_request(start, mark, 'transport="udp",result="hit"', client_address, key, cached_response)
+            return
+
+        task = asyncio.get_running_loop().create_task(self.resolve(data, key, client_address, start, mark))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def resolve(self, data, key, client_address, start, mark):
+        response, server = await resolve_async(data, key)
+        if STAGE_TIMING:
+            mark = metrics.stage('upstream', mark)
+        if response:
+            response = udp_response(response, data, key, client_address)
+            if response:
+                self.transport.sendto(response, client_address)
+            finish_request(start, mark, 'transport="udp",result="miss"', client_address, key, response, server)
+        else:
+            self.transport.sendto(ERROR_RESPONSE, client_address)
+            finish_request(start, mark, 'transport="udp",result="error"', client_address, key)
+
+# Ответ на запрос, пришедший по TCP: из кэша или от DNS-серверов. При конвейерной обработке
+# клиент сопоставляет ответы по ID, поэтому и ответ об ошибке получает ID запроса
+async def answer(data, client_address):
+    start = time.perf_counter()
+    key = parse_query(data)
+    response = server = None
+    if key:
+        zone = policy
+        response = zone.answer(data, key) if zone is not None else None
+        labels = 'transport="tcp",result="policy"'
+        if not response:
+            response = cache.get(key, data)
+            labels = 'transport="tcp",result="hit"'
+        if not response:
+            response, server = await resolve_async(data, key)
+            labels = 'transport="tcp",result="miss"'
+    if not response:
+        response = data[:2] + ERROR_RESPONSE[2:]
+        labels = 'transport="tcp",result="error"'
+    elapsed = time.perf_counter() - start
+    metrics.observe('dns_request_duration_seconds', elapsed, labels)
+    if query_log is not None:
+        query_log.add(elapsed, labels, client_address, key, response, server)
+    return response
+
+# Количество открытых TCP-соединений клиентов; меняется только в цикле событий TCP-сервера
+tcp_clients = 0
+
+# TCP-соединение клиента (RFC 7766): запросы читаются один за другим, не дожидаясь ответов,
+# а ответы отправляются по мере готовности, не обязательно в порядке запросов
+async def handle_tcp_client(reader, writer):
+    global tcp_clients
+    client_address = writer.get_extra_info('peername')
+    if access.rules and not access.admit(client_address):
+        writer.close()
+        return
+    if tcp_clients >= TCP_MAX_CLIENTS:
+        metrics.count('dns_tcp_rejected_total')
+        writer.close()
+        return
+    tcp_clients += 1
+    tasks = set()
+    slots = asyncio.Semaphore(TCP_MAX_PIPELINE)
+
+    async def reply(data):
+        try:
+            response = await answer(data, client_address)
+            if not writer.is_closing():
+                writer.write(struct.pack('!H', len(response)) + response)
+        finally:
+            slots.release()
+
+    try:
+        while True:
+            length, = struct.unpack('!H', await asyncio.wait_for(reader.readexactly(2), TCP_IDLE_TIMEOUT))
+            # Клиент, приславший длину и замолчавший, тоже не держит соединение дольше TCP_IDLE_TIMEOUT
+            data = await asyncio.wait_for(reader.readexactly(length), TCP_IDLE_TIMEOUT)
+            if CLIENT_RATE and not access.admit(client_address):
+                continue
+            if capture is not None:
+                capture.add(data)
+            await slots.acquire()
+            task = asyncio.ensure_future(reply(data))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+        pass
+    finally:
+        # Закрываем соединение, только когда отправлены ответы на все прочитанные запросы
+        if tasks:
+            await asyncio.wait(tasks)
+        writer.close()
+        tcp_clients -= 1
+
+# Запуск TCP-сервера в текущем цикле событий
+async def start_tcp_server():
+    return await asyncio.start_server(handle_tcp_client, sock=tcp_socket)
+
+# Основной цикл в асинхронном режиме
+async def listen_for_requests_async():
+    loop = asyncio.get_running_loop()
+    await open_channels(DNS_SERVERS)
+    transport, _ = await loop.create_datagram_endpoint(DNSServerProtocol, sock=server_socket)
+    tcp_server = await start_tcp_server()
+    stop = loop.create_future()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, lambda: stop.done() or stop.set_result(None))
+    # Сигнал мог прийти ещё до запуска цикла
+    if stop_requested:
+        stop.set_result(None)
     try:
-        import resource
-        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
-        resource.setrlimit(resource.RLIMIT_NOFILE, (65536, hard))
-        print(f"Лимит файловых дескрипторов увеличен до 65536")
-    except ImportError:
-        print("Не удалось увеличить лимит файловых дескрипторов. Продолжаем с текущим лимитом.")
+        await stop
+    finally:
+        transport.close()
+        tcp_server.close()
+        for channel in channels.values():
+            channel.close()
+
+# Создание сокета сервера (UDP или TCP); reuse_port позволяет нескольким процессам слушать один порт
+def create_server_socket(reuse_port=False, kind=socket.SOCK_DGRAM):
+    sock = socket.socket(socket.AF_INET, kind)
+    if kind == socket.SOCK_STREAM:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((LISTEN_ADDRESS, LISTEN_PORT))
+    return sock
+
+# Запуск сервера в текущем процессе; worker - номер рабочего процесса
+def serve(mode, reuse_port=False, worker=0):
+    global server_socket, tcp_socket, query_log, capture
+    server_socket = create_server_socket(reuse_port)
+    tcp_socket = create_server_socket(reuse_port, socket.SOCK_STREAM)
+
+    if QUERY_LOG_FILE:
+        query_log = QueryLog(f'{QUERY_LOG_FILE}-{worker}' if reuse_port else QUERY_LOG_FILE)
+        Thread(target=query_log.run, daemon=True).start()
+    if CAPTURE_FILE:
+        capture = QueryCapture(f'{CAPTURE_FILE}-{worker}' if reuse_port else CAPTURE_FILE)
+        Thread(target=capture.run, daemon=True).start()
 
     # Запуск потока для очистки кэша
     Thread(target=cleanup_cache, daemon=True).start()
 
-    # Запуск основного цикла
-    listen_for_requests()
+    if POLICY_FILE:
+        load_policy()
+        Thread(target=watch_policy, daemon=True).start()
+
+    if METRICS_PORT is not None:
+        start_metrics_server(METRICS_PORT + worker)
+
+    signal_fd = catch_signals()
+    # Рабочими процессами снимок открывает и сохраняет супервизор, а журнал у каждого процесса свой
+    if not reuse_port:
+        load_snapshot()
+        Thread(target=save_snapshots, daemon=True).start()
+
+    # Запуск основного цикла; в режиме 'asyncio' сигналы остановки ловит сам цикл событий,
+    # в остальных запросы обрабатывает фоновый поток, а главный ждёт сигнала
+    if mode == 'asyncio':
+        asyncio.run(listen_for_requests_async())
+    else:
+        start_upstream_loop(DNS_SERVERS)
+        # TCP-клиентов обслуживает цикл событий каналов
+        asyncio.run_coroutine_threadsafe(start_tcp_server(), upstream_loop).result()
+        Thread(target=listen_for_requests_batch if mode == 'batch' else listen_for_requests, daemon=True).start()
+        while not stop_requested:
+            wait_signal(signal_fd)
+    shutdown(save=not reuse_port)
+
+# Супервизор: запускает рабочие процессы на общем порту и перезапускает упавшие
+def run_workers(count, mode):
+    # pid -> номер рабочего процесса; перезапущенный процесс получает номер упавшего
+    workers = {}
+
+    def spawn(worker):
+        pid = os.fork()
+        if pid == 0:
+            signal.set_wakeup_fd(-1)
+            for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+                signal.signal(signum, signal.SIG_DFL)
+            try:
+                serve(mode, reuse_port=True, worker=worker)
+            finally:
+                os._exit(1)
+        workers[pid] = worker
+
+    # Снимок открывается до fork, и рабочие процессы переносят записи из него в общий кэш
+    load_snapshot()
+    Thread(target=save_snapshots, daemon=True).start()
+    # Главный поток просыпается на сигналы остановки и на завершение рабочих процессов (SIGCHLD)
+    signal_fd = catch_signals(signal.SIGCHLD)
+    for worker in range(count):
+        spawn(worker)
+    print(f"Запущено рабочих процессов: {count}")
+    while not stop_requested:
+        wait_signal(signal_fd)
+        while not stop_requested:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                break
+            worker = workers.pop(pid, None)
+            if worker is None:
+                continue
+            print(f"Рабочий процесс {pid} завершился (статус {status}), перезапуск")
+            time.sleep(1)
+            spawn(worker)
+    for pid in workers:
+        os.kill(pid, signal.SIGTERM)
+    shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="LuminDNS - кэширующий DNS-сервер")
+    parser.add_argument('--mode', choices=['threads', 'asyncio', 'batch'], default=SERVER_MODE,
+                        help="режим обработки запросов (по умолчанию %(default)s)")
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help="количество рабочих процессов (по умолчанию %(default)s)")
+    parser.add_argument('--port', type=int, default=LISTEN_PORT,
+                        help="порт для приёма запросов (по умолчанию %(default)s)")
+    parser.add_argument('--snapshot', default=SNAPSHOT_FILE,
+                        help="файл снимка кэша, пустая строка - не сохранять (по умолчанию %(default)s)")
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help="порт метрик в формате Prometheus, 0 - не запускать (по умолчанию %(default)s)")
+    parser.add_argument('--stage-timing', action='store_true', default=STAGE_TIMING,
+                        help="измерять время каждого этапа обработки запроса")
+    parser.add_argument('--policy', default=POLICY_FILE,
+                        help="файл блок-листов и переопределений, пустая строка - без него (по умолчанию %(default)s)")
+    parser.add_argument('--compile-policy', nargs='+', metavar='LIST',
+                        help="скомпилировать списки (домены, *.домены, формат hosts) в файл --policy и выйти")
+    parser.add_argument('--query-log', default=QUERY_LOG_FILE,
+                        help="вести двоичный журнал запросов в этом файле (по умолчанию %(default)s)")
+    parser.add_argument('--capture', default=CAPTURE_FILE,
+                        help="захватывать входящие запросы в этот файл для dnsreplay.py (по умолчанию %(default)s)")
+    parser.add_argument('--servers', nargs='+', metavar='SERVER', default=DNS_SERVERS,
+                        help="DNS-серверы вместо DNS_SERVERS, например 1.1.1.1 tls://9.9.9.9#dns.quad9.net")
+    parser.add_argument('--upstream-ca-file', default=UPSTREAM_CA_FILE,
+                        help="файл корневых сертификатов для проверки DoT/DoH-серверов (по умолчанию системные)")
+    parser.add_argument('--read-query-log', nargs='+', metavar='FILE',
+                        help="вывести файлы журнала запросов в формате CSV и выйти")
+    args = parser.parse_args()
+    LISTEN_PORT = args.port
+    POLICY_FILE = args.policy or None
+    SNAPSHOT_FILE = args.snapshot or None
+    METRICS_PORT = args.metrics_port or None
+    STAGE_TIMING = args.stage_timing
+    QUERY_LOG_FILE = args.query_log or None
+    CAPTURE_FILE = args.capture or None
+    DNS_SERVERS = args.servers
+    UPSTREAM_CA_FILE = args.upstream_ca_file or None
+
+    if args.read_query_log:
+        writer = csv.writer(sys.stdout)
+        writer.writerow(['time', 'client', 'port', 'transport', 'qname', 'qtype', 'rcode', 'result', 'latency_ms', 'upstream'])
+        try:
+            for path in args.read_query_log:
+                for record in QueryLog.read(path):
+                    writer.writerow([
+                        datetime.fromtimestamp(record['time']).isoformat(timespec='microseconds'),
+                        record['client'], record['port'], record['transport'], record['qname'], record['qtype'],
+                        record['rcode'], record['result'], f"{record['latency'] * 1000:.3f}", record['upstream'],
+                    ])
+        except BrokenPipeError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"Не удалось прочитать журнал запросов: {e}")
+            sys.exit(1)
+        sys.exit(0)
+
+    if args.compile_policy:
+        if not POLICY_FILE:
+            parser.error("для --compile-policy нужен файл --policy")
+        count = PolicyZone.compile(POLICY_FILE, args.compile_policy)
+        print(f"Политика {POLICY_FILE}: {count} правил")
+        sys.exit(0)
+
+    if args.workers > 1:
+        # Кэш создаётся до fork, чтобы все процессы работали с одной и той же памятью
+        cache = SharedCache()
+        run_workers(args.workers, args.mode)
+    else:
+        serve(args.mode)
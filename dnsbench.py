@@ -0,0 +1,423 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import runpy
+import shlex
+import socket
+import ssl
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+from dnstest import build_dns_query
+
+# Версии сервера для сравнения (скрипт и аргументы)
+TARGETS = ['dns.py', 'dns6.py', 'dns6v2.py', 'dns7.py', 'dns7.py --mode asyncio']
+LISTEN_PORT = 5353  # Порт, на котором запускается проверяемый сервер
+STUB_PORT = 5354  # Порт локального DNS-сервера-заглушки вместо внешних серверов
+QPS = 500  # Целевое количество запросов в секунду
+DURATION = 10.0  # Длительность замера (в секундах)
+QUERY_TIMEOUT = 2.0  # Через сколько секунд запрос без ответа считается потерянным
+NAMES = 1000  # Количество различных доменов в нагрузке
+ZIPF_S = 1.0  # Параметр распределения Ципфа для популярности доменов
+SOCKETS = 8  # Количество сокетов генератора (по 65536 ID транзакций на каждый)
+STUB_DELAY = 0.02  # Задержка ответа заглушки (в секундах)
+STUB_JITTER = 0.005  # Случайный разброс задержки заглушки (в секундах)
+STUB_LOSS = 0.0  # Доля запросов, на которые заглушка не отвечает
+STUB_SERVFAIL = 0.0  # Доля запросов, на которые заглушка отвечает SERVFAIL
+STUB_TTL = 300  # TTL записей в ответах заглушки
+STUB_TRANSPORT = 'udp'  # Протокол заглушки: 'udp', 'tls' (DoT) или 'https' (DoH); DoT и DoH поддерживает только dns7.py
+
+# Смещение конца секции вопроса (после QTYPE и QCLASS)
+def question_end(data):
+    i = 12
+    while data[i] != 0:
+        i += data[i] + 1
+    return i + 5
+
+# Ответы DNS-сервера-заглушки: A-запись с настраиваемыми задержкой, потерями и SERVFAIL
+class StubResponder:
+    def __init__(self, delay, jitter, loss, servfail, ttl, counter):
+        self.delay = delay
+        self.jitter = jitter
+        self.loss = loss
+        self.servfail = servfail
+        self.ttl = ttl
+        self.counter = counter
+
+    # (ответ, задержка) или None, если запрос теряется
+    def respond(self, data):
+        self.counter.value += 1
+        try:
+            question = data[12:question_end(data)]
+        except IndexError:
+            return None
+        if random.random() < self.loss:
+            return None
+        if random.random() < self.servfail:
+            response = data[:2] + struct.pack('!5H', 0x8182, 1, 0, 0, 0) + question
+        else:
+            address = bytes([10, 0, 0, 1 + len(question) % 250])
+            response = (data[:2] + struct.pack('!5H', 0x8180, 1, 1, 0, 0) + question
+                        + b'\xc0\x0c' + struct.pack('!HHIH', 1, 1, self.ttl, 4) + address)
+        return response, self.delay + random.uniform(0, self.jitter)
+
+# Заглушка по UDP
+class StubProtocol(asyncio.DatagramProtocol):
+    def __init__(self, responder):
+        self.responder = responder
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        result = self.responder.respond(data)
+        if result is None:
+            return
+        response, delay = result
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self.transport.sendto, response, addr)
+        else:
+            self.transport.sendto(response, addr)
+
+# Соединение с заглушкой по DNS-over-TLS (RFC 7858) или DNS-over-HTTPS (RFC 8484, HTTP/1.1).
+# Ответы DoT отправляются по мере готовности, ответы DoH - в порядке запросов, как требует HTTP/1.1;
+# потерянный запрос DoH получает ответ 503, иначе следующие ответы сдвинулись бы
+async def serve_stream(responder, https, reader, writer):
+    previous = None
+    try:
+        while True:
+            if https:
+                head = await reader.readuntil(b'\r\n\r\n')
+                length = 0
+                for line in head.split(b'\r\n')[1:]:
+                    name, _, value = line.partition(b':')
+                    if name.strip().lower() == b'content-length':
+                        length = int(value)
+            else:
+                length, = struct.unpack('!H', await reader.readexactly(2))
+            result = responder.respond(await reader.readexactly(length))
+            if https:
+                previous = asyncio.ensure_future(send_http(writer, result, previous))
+            elif result is not None:
+                asyncio.ensure_future(send_framed(writer, *result))
+    except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        pass
+    finally:
+        writer.close()
+
+async def send_framed(writer, response, delay):
+    await asyncio.sleep(delay)
+    writer.write(struct.pack('!H', len(response)) + response)
+
+async def send_http(writer, result, previous):
+    if result is not None:
+        await asyncio.sleep(result[1])
+    if previous is not None:
+        await previous
+    if result is None:
+        writer.write(b'HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n\r\n')
+    else:
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/dns-message\r\n'
+                     b'Content-Length: %d\r\n\r\n' % len(result[0]) + result[0])
+
+# Самоподписанный сертификат заглушки для 127.0.0.1: (сертификат, ключ) в каталоге directory.
+# Его же проверяемый сервер получает как файл корневых сертификатов
+def make_certificate(directory):
+    certificate = os.path.join(directory, 'stub.pem')
+    key = os.path.join(directory, 'stub.key')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-subj', '/CN=127.0.0.1', '-addext', 'subjectAltName=IP:127.0.0.1',
+                    '-keyout', key, '-out', certificate],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certificate, key
+
+# Адрес заглушки DoT или DoH для --servers проверяемого сервера
+def stub_server(transport, port):
+    if transport == 'tls':
+        return f'tls://127.0.0.1:{port}'
+    return f'https://127.0.0.1:{port}/dns-query'
+
+# Запуск заглушки (в отдельном процессе). transport - 'udp', 'tls' или 'https';
+# для 'tls' и 'https' нужен certificate - (сертификат, ключ)
+def run_stub(port, delay, jitter, loss, servfail, ttl, counter, transport='udp', certificate=None):
+    async def serve():
+        loop = asyncio.get_running_loop()
+        responder = StubResponder(delay, jitter, loss, servfail, ttl, counter)
+        if transport == 'udp':
+            await loop.create_datagram_endpoint(lambda: StubProtocol(responder), local_addr=('127.0.0.1', port))
+        else:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(*certificate)
+            context.set_alpn_protocols(['dot' if transport == 'tls' else 'http/1.1'])
+            await asyncio.start_server(lambda reader, writer: serve_stream(responder, transport == 'https', reader, writer),
+                                       '127.0.0.1', port, ssl=context)
+        await loop.create_future()
+    asyncio.run(serve())
+
+# Запуск версии сервера с подменой портов: прослушивание порта 53 переносится
+# на listen_port, запросы к внешним серверам (порт 53) уходят на заглушку.
+# Так старые версии с жёстко заданными адресами проверяются без изменений.
+def run_target(script, args, listen_port, stub_port):
+    original_socket = socket.socket
+
+    def redirect(address, port):
+        if isinstance(address, tuple) and address[1] == 53:
+            return ('127.0.0.1', port)
+        return address
+
+    class RedirectedSocket(original_socket):
+        def bind(self, address):
+            return super().bind(redirect(address, listen_port))
+
+        def connect(self, address):
+            return super().connect(redirect(address, stub_port))
+
+        def sendto(self, data, *args):
+            return super().sendto(data, *args[:-1], redirect(args[-1], stub_port))
+
+    socket.socket = RedirectedSocket
+    sys.argv = [script] + args
+    runpy.run_path(script, run_name='__main__')
+
+# Популярность доменов по закону Ципфа: накопленные веса для random.choices
+def zipf_weights(count, s):
+    weights = [1 / (rank ** s) for rank in range(1, count + 1)]
+    total = 0.0
+    cumulative = []
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    return cumulative
+
+# Сокет генератора нагрузки: сопоставляет ответы отправленным запросам по ID
+class LoadProtocol(asyncio.DatagramProtocol):
+    def __init__(self, results):
+        self.results = results
+        self.pending = {}
+        self.next_id = random.getrandbits(16)
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def send(self, query):
+        self.next_id = (self.next_id + 1) & 0xFFFF
+        request_id = self.next_id.to_bytes(2, 'big')
+        if request_id in self.pending:
+            self.results['timeouts'] += 1
+        self.pending[request_id] = time.perf_counter()
+        self.transport.sendto(request_id + query[2:])
+
+    def datagram_received(self, data, addr):
+        sent = self.pending.pop(data[:2], None)
+        if sent is None:
+            self.results['unmatched'] += 1
+            return
+        latency = time.perf_counter() - sent
+        if latency > QUERY_TIMEOUT:
+            self.results['timeouts'] += 1
+        elif len(data) < 4 or data[3] & 0x0F:
+            self.results['errors'] += 1
+        else:
+            self.results['latencies'].append(latency)
+
+# Генератор нагрузки с открытым циклом: запросы уходят по расписанию, не дожидаясь ответов
+async def generate_load(server, qps, duration, names, zipf_s, sockets):
+    loop = asyncio.get_running_loop()
+    results = {'sent': 0, 'errors': 0, 'timeouts': 0, 'unmatched': 0, 'latencies': []}
+    protocols = []
+    for _ in range(sockets):
+        _, protocol = await loop.create_datagram_endpoint(lambda: LoadProtocol(results), remote_addr=server)
+        protocols.append(protocol)
+
+    queries = [build_dns_query(f'host{n}.bench.test') for n in range(names)]
+    weights = zipf_weights(names, zipf_s)
+    start = time.perf_counter()
+    while True:
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            break
+        # Отправляем все запросы, которые должны были уйти к этому моменту
+        due = int(elapsed * qps) - results['sent']
+        for query in random.choices(queries, cum_weights=weights, k=due):
+            protocols[results['sent'] % sockets].send(query)
+            results['sent'] += 1
+        await asyncio.sleep(0.001)
+    elapsed = time.perf_counter() - start
+
+    # Ждём запоздавшие ответы
+    await asyncio.sleep(QUERY_TIMEOUT)
+    for protocol in protocols:
+        results['timeouts'] += len(protocol.pending)
+        protocol.transport.close()
+    results['elapsed'] = elapsed
+    return results
+
+# Проверка, что сервер запустился и отвечает
+def wait_ready(server, timeout=10.0):
+    deadline = time.time() + timeout
+    query = build_dns_query('ready.bench.test')
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.settimeout(0.5)
+        while time.time() < deadline:
+            try:
+                s.sendto(query, server)
+                s.recvfrom(4096)
+                return True
+            except OSError:
+                time.sleep(0.2)
+    return False
+
+def percentile(values, p):
+    if not values:
+        return None
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+# Сводка по одному замеру
+def summarize(name, results, upstream):
+    latencies = sorted(results['latencies'])
+    sent = results['sent']
+    row = {
+        'target': name,
+        'sent': sent,
+        'ok': len(latencies),
+        'errors': results['errors'],
+        'timeouts': results['timeouts'],
+        'loss': results['timeouts'] / sent if sent else 0.0,
+        'qps': len(latencies) / results['elapsed'] if results['elapsed'] else 0.0,
+        'upstream': upstream,
+    }
+    for label, p in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('p999', 0.999)):
+        value = percentile(latencies, p)
+        row[label] = value * 1000 if value is not None else None
+    return row
+
+# Столбцы таблицы результатов: (ключ сводки, заголовок, формат)
+COLUMNS = [('target', 'Сервер', '{}'), ('sent', 'Отправлено', '{}'), ('ok', 'Успешно', '{}'),
+           ('errors', 'Ошибки', '{}'), ('timeouts', 'Тайм-ауты', '{}'), ('loss', 'Потери', '{:.2%}'),
+           ('qps', 'Ответов/с', '{:.0f}'), ('p50', 'p50 мс', '{:.2f}'), ('p90', 'p90 мс', '{:.2f}'),
+           ('p99', 'p99 мс', '{:.2f}'), ('p999', 'p999 мс', '{:.2f}'), ('upstream', 'К заглушке', '{}')]
+
+def print_table(rows, columns=COLUMNS):
+    table = [[title for _, title, _ in columns]]
+    for row in rows:
+        table.append(['-' if row[key] is None else fmt.format(row[key]) for key, _, fmt in columns])
+    widths = [max(len(line[i]) for line in table) for i in range(len(columns))]
+    for n, line in enumerate(table):
+        print('  '.join(cell.ljust(width) if i == 0 else cell.rjust(width)
+                        for i, (cell, width) in enumerate(zip(line, widths))))
+        if n == 0:
+            print('  '.join('-' * width for width in widths))
+
+# Запуск версии сервера в отдельном процессе через --run-target; cwd - рабочий каталог сервера,
+# extra_args - дополнительные аргументы сервера
+def start_target(target, port, stub_port, cwd=None, extra_args=()):
+    script, *script_args = shlex.split(target)
+    script_args += extra_args
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), script)
+    command = [sys.executable, os.path.abspath(__file__), '--run-target', script,
+               '--port', str(port), '--stub-port', str(stub_port), '--'] + script_args
+    return subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=cwd)
+
+def stop_target(process):
+    process.terminate()
+    try:
+        process.wait(5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+# Замер одной версии сервера: запуск, прогрев, нагрузка, остановка. Сервер запускается
+# во временном каталоге, чтобы снимок кэша от предыдущей версии не прогрел кэш следующей
+def bench_target(target, args, counter, extra_args=()):
+    with tempfile.TemporaryDirectory() as directory:
+        process = start_target(target, args.port, args.stub_port, cwd=directory, extra_args=extra_args)
+        server = ('127.0.0.1', args.port)
+        try:
+            if not wait_ready(server):
+                print(f"Сервер {target} не ответил, пропускаем")
+                return None
+            upstream_before = counter.value
+            results = asyncio.run(generate_load(server, args.qps, args.duration, args.names, args.zipf, args.sockets))
+            return summarize(target, results, counter.value - upstream_before)
+        finally:
+            stop_target(process)
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочное тестирование версий LuminDNS")
+    parser.add_argument('targets', nargs='*',
+                        help="версии сервера для сравнения, например 'dns7.py --mode asyncio' "
+                             "(по умолчанию все версии из TARGETS)")
+    parser.add_argument('--server', help="замерить уже запущенный сервер HOST:PORT вместо запуска версий")
+    parser.add_argument('--port', type=int, default=LISTEN_PORT, help="порт проверяемого сервера")
+    parser.add_argument('--stub-port', type=int, default=STUB_PORT, help="порт заглушки")
+    parser.add_argument('--qps', type=float, default=QPS, help="целевое количество запросов в секунду")
+    parser.add_argument('--duration', type=float, default=DURATION, help="длительность замера (в секундах)")
+    parser.add_argument('--names', type=int, default=NAMES, help="количество различных доменов")
+    parser.add_argument('--zipf', type=float, default=ZIPF_S, help="параметр распределения Ципфа")
+    parser.add_argument('--sockets', type=int, default=SOCKETS, help="количество сокетов генератора")
+    parser.add_argument('--delay', type=float, default=STUB_DELAY, help="задержка заглушки (в секундах)")
+    parser.add_argument('--jitter', type=float, default=STUB_JITTER, help="разброс задержки заглушки")
+    parser.add_argument('--loss', type=float, default=STUB_LOSS, help="доля потерь заглушки")
+    parser.add_argument('--servfail', type=float, default=STUB_SERVFAIL, help="доля SERVFAIL заглушки")
+    parser.add_argument('--ttl', type=int, default=STUB_TTL, help="TTL записей заглушки")
+    parser.add_argument('--upstream', choices=['udp', 'tls', 'https'], default=STUB_TRANSPORT,
+                        help="протокол заглушки: udp, tls (DoT) или https (DoH); tls и https - только для dns7.py")
+    parser.add_argument('--run-target', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_target:
+        # Аргументы самой версии сервера передаются после '--'
+        run_target(args.run_target, args.targets, args.port, args.stub_port)
+        return
+
+    if args.server:
+        host, _, port = args.server.rpartition(':')
+        results = asyncio.run(generate_load((host, int(port)), args.qps, args.duration,
+                                            args.names, args.zipf, args.sockets))
+        print_table([summarize(args.server, results, None)])
+        return
+
+    targets = args.targets or TARGETS
+    if args.upstream != 'udp':
+        # Старые версии не умеют DoT и DoH, поэтому по умолчанию замеряются только версии dns7.py
+        if not args.targets:
+            targets = [target for target in TARGETS if shlex.split(target)[0] == 'dns7.py']
+        elif any(shlex.split(target)[0] != 'dns7.py' for target in targets):
+            parser.error(f"--upstream {args.upstream} поддерживает только dns7.py")
+
+    with tempfile.TemporaryDirectory() as directory:
+        certificate = None
+        extra_args = []
+        if args.upstream != 'udp':
+            try:
+                certificate = make_certificate(directory)
+            except (OSError, subprocess.CalledProcessError) as e:
+                parser.error(f"не удалось создать сертификат заглушки (нужна утилита openssl): {e}")
+            extra_args = ['--servers', stub_server(args.upstream, args.stub_port), '--upstream-ca-file', certificate[0]]
+
+        counter = multiprocessing.Value('Q', 0, lock=False)
+        stub = multiprocessing.Process(target=run_stub, daemon=True,
+                                       args=(args.stub_port, args.delay, args.jitter, args.loss,
+                                             args.servfail, args.ttl, counter, args.upstream, certificate))
+        stub.start()
+        rows = []
+        try:
+            for target in targets:
+                print(f"Замер {target}: {args.qps:.0f} запросов/с, {args.duration:.0f} с")
+                row = bench_target(target, args, counter, extra_args)
+                if row:
+                    rows.append(row)
+        finally:
+            stub.terminate()
+    print()
+    print_table(rows)
+
+if __name__ == "__main__":
+    main()
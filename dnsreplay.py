@@ -0,0 +1,225 @@
+import argparse
+import asyncio
+import heapq
+import multiprocessing
+import struct
+import tempfile
+import time
+
+from dns7 import QueryCapture, QueryLog
+from dnsbench import (COLUMNS, LISTEN_PORT, QUERY_TIMEOUT, SOCKETS, STUB_DELAY, STUB_JITTER, STUB_LOSS,
+                      STUB_PORT, STUB_SERVFAIL, STUB_TTL, LoadProtocol, percentile, print_table, run_stub,
+                      start_target, stop_target, summarize, wait_ready)
+
+# Версии сервера, на которых воспроизводится трафик
+TARGETS = ['dns7.py']
+SPEED = 1.0  # Во сколько раз быстрее записи воспроизводить трафик
+INTERVAL = 10.0  # Длина интервала в отчёте по времени (в секундах воспроизведения)
+
+# Запрос по имени и типу из журнала запросов
+def build_query(qname, qtype):
+    labels = [label.encode() for label in qname.rstrip('.').split('.') if label]
+    return (struct.pack('!6H', 0, 0x0100, 1, 0, 0, 0) + b''.join(bytes((len(label),)) + label for label in labels)
+            + b'\0' + struct.pack('!HH', qtype, 1))
+
+# Трасса из файлов захвата (dns7.py --capture) или журналов запросов (dns7.py --query-log):
+# список (время, запрос), упорядоченный по времени. У журнала запросов нет самих запросов,
+# поэтому они собираются заново по имени и типу, без EDNS и бита DO
+def load_trace(paths):
+    streams = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            magic = f.read(len(QueryCapture.MAGIC))
+        if magic == QueryCapture.MAGIC:
+            streams.append(QueryCapture.read(path))
+        elif magic == QueryLog.MAGIC:
+            streams.append((record['time'], build_query(record['qname'], record['qtype']))
+                           for record in QueryLog.read(path))
+        else:
+            raise ValueError(f"{path}: это не захват и не журнал запросов")
+    return list(heapq.merge(*streams, key=lambda record: record[0]))
+
+# Сокет воспроизведения: кроме задержек запоминает, когда был отправлен каждый отвеченный запрос
+class ReplayProtocol(LoadProtocol):
+    def datagram_received(self, data, addr):
+        sent = self.pending.pop(data[:2], None)
+        if sent is None:
+            self.results['unmatched'] += 1
+            return
+        latency = time.perf_counter() - sent
+        if latency > QUERY_TIMEOUT:
+            self.results['timeouts'] += 1
+            return
+        error = len(data) < 4 or bool(data[3] & 0x0F)
+        if error:
+            self.results['errors'] += 1
+        else:
+            self.results['latencies'].append(latency)
+        self.results['answers'].append((sent, latency, error))
+
+# Воспроизведение трассы с исходными промежутками между запросами, ускоренными в speed раз.
+# counter - счётчик запросов к заглушке, он снимается на границе каждого интервала
+async def replay(server, trace, speed, sockets, counter, interval):
+    loop = asyncio.get_running_loop()
+    results = {'sent': 0, 'errors': 0, 'timeouts': 0, 'unmatched': 0, 'latencies': [], 'answers': [],
+               'sent_by_interval': [], 'upstream_samples': []}
+    protocols = []
+    for _ in range(sockets):
+        _, protocol = await loop.create_datagram_endpoint(lambda: ReplayProtocol(results), remote_addr=server)
+        protocols.append(protocol)
+
+    first = trace[0][0]
+    sent_by_interval = results['sent_by_interval']
+    samples = results['upstream_samples']
+    start = results['start'] = time.perf_counter()
+    i = 0
+    while i < len(trace):
+        elapsed = time.perf_counter() - start
+        while counter is not None and elapsed >= len(samples) * interval:
+            samples.append(counter.value)
+        # Отправляем все запросы, время которых уже наступило
+        while i < len(trace) and (trace[i][0] - first) / speed <= elapsed:
+            protocols[i % sockets].send(trace[i][1])
+            slot = int(elapsed / interval)
+            while len(sent_by_interval) <= slot:
+                sent_by_interval.append(0)
+            sent_by_interval[slot] += 1
+            i += 1
+        await asyncio.sleep(0.001)
+    results['sent'] = i
+    results['elapsed'] = time.perf_counter() - start
+
+    # Ждём запоздавшие ответы
+    await asyncio.sleep(QUERY_TIMEOUT)
+    if counter is not None:
+        samples.append(counter.value)
+    for protocol in protocols:
+        results['timeouts'] += len(protocol.pending)
+        protocol.transport.close()
+    return results
+
+# Оценка доли попаданий в кэш: доля успешных ответов, для которых сервер не обращался к заглушке.
+# Фоновые обновления и дублирующие запросы тоже идут к заглушке, поэтому оценка занижена
+def hit_rate(answered, upstream):
+    if upstream is None or not answered:
+        return None
+    return max(0.0, 1 - upstream / answered)
+
+# Отчёт по интервалам: запросы, ответы, запросы к заглушке, доля попаданий и задержки
+def interval_rows(results, interval):
+    answers = [[] for _ in results['sent_by_interval']]
+    errors = [0] * len(answers)
+    for sent, latency, error in results['answers']:
+        slot = min(int((sent - results['start']) / interval), len(answers) - 1)
+        if error:
+            errors[slot] += 1
+        else:
+            answers[slot].append(latency)
+    samples = results['upstream_samples']
+    rows = []
+    for slot, sent in enumerate(results['sent_by_interval']):
+        latencies = sorted(answers[slot])
+        # Запросы к заглушке за последний интервал включают и ответы, пришедшие после его конца
+        upstream = samples[slot + 1] - samples[slot] if slot + 1 < len(samples) else None
+        row = {
+            'target': f'{slot * interval:g}-{(slot + 1) * interval:g} с',
+            'sent': sent,
+            'ok': len(latencies),
+            'errors': errors[slot],
+            'upstream': upstream,
+        }
+        row['hit_rate'] = hit_rate(row['ok'], upstream)
+        for label, p in (('p50', 0.5), ('p99', 0.99)):
+            value = percentile(latencies, p)
+            row[label] = value * 1000 if value is not None else None
+        rows.append(row)
+    return rows
+
+INTERVAL_COLUMNS = [('target', 'Интервал', '{}'), ('sent', 'Запросов', '{}'), ('ok', 'Успешно', '{}'),
+                    ('errors', 'Ошибки', '{}'), ('upstream', 'К заглушке', '{}'), ('hit_rate', 'Попадания', '{:.1%}'),
+                    ('p50', 'p50 мс', '{:.2f}'), ('p99', 'p99 мс', '{:.2f}')]
+SUMMARY_COLUMNS = COLUMNS + [('hit_rate', 'Попадания', '{:.1%}')]
+
+# Сводка по всему воспроизведению
+def summary_row(name, results, upstream):
+    row = summarize(name, results, upstream)
+    row['hit_rate'] = hit_rate(row['ok'], upstream)
+    return row
+
+def report(name, results, upstream, interval):
+    print(f"{name}: по интервалам")
+    print_table(interval_rows(results, interval), INTERVAL_COLUMNS)
+    print()
+    return summary_row(name, results, upstream)
+
+# Воспроизведение на одной версии сервера. Сервер запускается во временном каталоге,
+# чтобы снимок кэша от прошлых запусков не искажал результат
+def replay_target(target, trace, args, counter):
+    with tempfile.TemporaryDirectory() as directory:
+        process = start_target(target, args.port, args.stub_port, cwd=directory)
+        server = ('127.0.0.1', args.port)
+        try:
+            if not wait_ready(server):
+                print(f"Сервер {target} не ответил, пропускаем")
+                return None
+            upstream_before = counter.value
+            results = asyncio.run(replay(server, trace, args.speed, args.sockets, counter, args.interval))
+            return report(target, results, counter.value - upstream_before, args.interval)
+        finally:
+            stop_target(process)
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение записанного трафика на версиях LuminDNS")
+    parser.add_argument('traces', nargs='+',
+                        help="файлы захвата (dns7.py --capture) или журналы запросов (dns7.py --query-log)")
+    parser.add_argument('--target', action='append',
+                        help="версия сервера, например 'dns7.py --mode asyncio'; можно указать несколько раз "
+                             "(по умолчанию %s)" % ', '.join(TARGETS))
+    parser.add_argument('--server', help="воспроизвести на уже запущенном сервере HOST:PORT вместо запуска версий")
+    parser.add_argument('--speed', type=float, default=SPEED, help="во сколько раз ускорить воспроизведение")
+    parser.add_argument('--interval', type=float, default=INTERVAL, help="длина интервала в отчёте (в секундах)")
+    parser.add_argument('--port', type=int, default=LISTEN_PORT, help="порт проверяемого сервера")
+    parser.add_argument('--stub-port', type=int, default=STUB_PORT, help="порт заглушки")
+    parser.add_argument('--sockets', type=int, default=SOCKETS, help="количество сокетов генератора")
+    parser.add_argument('--delay', type=float, default=STUB_DELAY, help="задержка заглушки (в секундах)")
+    parser.add_argument('--jitter', type=float, default=STUB_JITTER, help="разброс задержки заглушки")
+    parser.add_argument('--loss', type=float, default=STUB_LOSS, help="доля потерь заглушки")
+    parser.add_argument('--servfail', type=float, default=STUB_SERVFAIL, help="доля SERVFAIL заглушки")
+    parser.add_argument('--ttl', type=int, default=STUB_TTL, help="TTL записей заглушки")
+    args = parser.parse_args()
+    if args.speed <= 0:
+        parser.error("--speed должен быть больше нуля")
+
+    try:
+        trace = load_trace(args.traces)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    if not trace:
+        parser.error("в трассе нет запросов")
+    span = trace[-1][0] - trace[0][0]
+    print(f"Трасса: {len(trace)} запросов за {span:.0f} с, воспроизведение за {span / args.speed:.0f} с")
+
+    if args.server:
+        host, _, port = args.server.rpartition(':')
+        results = asyncio.run(replay((host, int(port)), trace, args.speed, args.sockets, None, args.interval))
+        print_table([report(args.server, results, None, args.interval)], SUMMARY_COLUMNS)
+        return
+
+    counter = multiprocessing.Value('Q', 0, lock=False)
+    stub = multiprocessing.Process(target=run_stub, daemon=True,
+                                   args=(args.stub_port, args.delay, args.jitter, args.loss,
+                                         args.servfail, args.ttl, counter))
+    stub.start()
+    rows = []
+    try:
+        for target in args.target or TARGETS:
+            print(f"Воспроизведение на {target}")
+            row = replay_target(target, trace, args, counter)
+            if row:
+                rows.append(row)
+    finally:
+        stub.terminate()
+    print_table(rows, SUMMARY_COLUMNS)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,13 @@
+import socket, sys, time
+sys.path.insert(0,'/root/package')
+from dnstest import build_dns_query
+qs = [build_dns_query(f'h{i}.t') for i in range(20)]
+s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM); s.setblocking(False)
+end = time.time() + float(sys.argv[1])
+while time.time() < end:
+    for q in qs:
+        try: s.sendto(q, ('127.0.0.1', 35353))
+        except OSError: pass
+    try:
+        while True: s.recv(4096)
+    except OSError: pass